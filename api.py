@@ -3,11 +3,11 @@ Functions for interacting with Yahoo and NFL fantasy football APIs.
 """
 
 # Standard library imports
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 import urllib.parse
 from pathlib import Path
-import requests
 
 # Third-party imports
 import pandas as pd
@@ -16,6 +16,9 @@ import yaml
 import yahoo_fantasy_api as yapi
 from yahoo_oauth import OAuth2
 
+# Local imports
+import transport
+
 with open('_config.yml', 'r') as config_file:
     CONFIG = yaml.safe_load(config_file)
 
@@ -37,6 +40,7 @@ def authenticate():
     auth = OAuth2(None, None, from_file='_oauth.json')
     if not auth.token_is_valid():
         auth.refresh_access_token()
+    transport.transport().adopt(auth.session)
     return auth
 
 
@@ -47,15 +51,59 @@ def free_agents(position=None):
     :return: pandas data frame
     """
     lg = league()
-    if position:
-        df = pd.DataFrame(lg.free_agents(position))
-    else:
-        dfs = [pd.DataFrame(lg.free_agents(pos)) for pos in lg.positions()]
-        df = pd.concat(dfs)
+    positions = [position] if position else lg.positions()
+    dfs = [pd.DataFrame(position_agents) for position_agents in _position_free_agents(lg, positions)]
+    df = pd.concat(dfs)
 
     return df
 
 
+def free_agent_pool(lg=None):
+    """
+    Gets every free agent in the league, requesting all positions concurrently.
+    :param lg: Optional league object, to avoid authenticating again
+    :return: dict of free agent details keyed by Yahoo player ID (as a string)
+    """
+    lg = lg or league()
+    pool = {}
+    for position_agents in _position_free_agents(lg, lg.positions()):
+        for agent in position_agents:
+            pool[str(agent['player_id'])] = agent
+    return pool
+
+
+def _position_free_agents(lg, positions):
+    """
+    Requests free agents for several positions in parallel.
+    :param lg: league object from the Yahoo API
+    :param positions: iterable of position codes e.g. ['QB', 'WR']
+    :return: list of lists of free agent dicts, one list per position
+    """
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(lg.free_agents, positions))
+
+
+def matchup_teams(lg, week):
+    """
+    Gets the names of the teams playing each other in a given week.
+    :param lg: object representing the league resource from Yahoo API
+    :param week: int for the chosen fantasy week
+    :return: list of tuples of two team names
+    """
+    api_response = lg.matchups(week)
+    week_matchups = api_response['fantasy_content']['league'][1]['scoreboard']['0']['matchups']
+
+    ret = []
+    for val in week_matchups.values():
+        if isinstance(val, int):
+            continue
+        team1 = val['matchup']['0']['teams']['0']['team'][0][2]['name']
+        team2 = val['matchup']['0']['teams']['1']['team'][0][2]['name']
+        ret.append((team1, team2))
+
+    return ret
+
+
 def player(p_name=None, p_id=None):
     """
     Gets the Yahoo fantasy details for a particular name.
@@ -71,7 +119,7 @@ def player(p_name=None, p_id=None):
         player_key = f'nfl.p{p_id}'
         url = 'http://fantasysports.yahooapis.com/fantasy/v2/player/' + player_key
         # TODO - authenticate oauth session
-        ret = requests.get(url)
+        ret = transport.get(url)
         print(ret)
         return
 
@@ -138,12 +186,40 @@ def download_game_data():
             file_path = Path(f'data_in/nfl-weekstats-{year}-{week:02}.json')
             if not file_path.exists():
                 url = f'https://api.fantasy.nfl.com/v2/players/weekstats?season={year}&week={week:02}'
-                response = requests.get(url)
+                response = transport.get(url)
                 if response.status_code == 200:
                     with open(file_path, 'w+') as f:
                         f.write(response.text)
 
 
+def scoreboard_points(lg, week):
+    """
+    Gets the projected and actual points for every team in a week from a single scoreboard call.
+    :param lg: object representing the league resource from Yahoo API
+    :param week: int for the chosen fantasy week
+    :return: list of dicts containing team key, week, projected points and actual points
+    """
+    api_response = lg.matchups(week)
+    week_matchups = api_response['fantasy_content']['league'][1]['scoreboard']['0']['matchups']
+
+    ret = []
+    for val in week_matchups.values():
+        if isinstance(val, int):
+            continue
+        for team_val in val['matchup']['0']['teams'].values():
+            if isinstance(team_val, int):
+                continue
+            team_details, team_points = team_val['team'][0], team_val['team'][1]
+            team_key = next(detail['team_key'] for detail in team_details
+                            if isinstance(detail, dict) and 'team_key' in detail)
+            ret.append({'team_key': team_key,
+                        'week': week,
+                        'proj_points': float(team_points['team_projected_points']['total']),
+                        'act_points': float(team_points['team_points']['total'])})
+
+    return ret
+
+
 def scrape_player(p_name):
     """
     If searching for a player in the Yahoo API fails, try to scrape their details from the website.
@@ -154,7 +230,7 @@ def scrape_player(p_name):
     p_name = urllib.parse.quote(p_name)
 
     search_url = f'https://sports.yahoo.com/site/api/resource/searchassist;searchTerm={p_name}'
-    response = requests.get(search_url)
+    response = transport.get(search_url)
 
     if response.status_code != 200:
         return {}
@@ -176,20 +252,103 @@ def scrape_player(p_name):
     return filtered_hits[0]['data']
 
 
-def search_tweets(search_text):
+def search_page(search_text, since_id=None, max_id=None, count=100, client=None):
     """
-    Searches twitter for statuses with the given search text.
+    Searches twitter for one page of statuses with the given search text, excluding retweets.
     :param search_text: string to search for
+    :param since_id: Optional, only return statuses newer than this ID
+    :param max_id: Optional, only return statuses at or older than this ID
+    :param count: maximum number of statuses to return
+    :param client: Optional tweepy API object, created from the config file if not provided
+    :return: list of dicts representing basic tweet info, and the ID of the oldest status on the
+             page before retweets were removed (None if the page was empty), for paging back from
+    """
+    client = client or twitter_api()
+    results = client.search(q=f'{search_text} -filter:retweets', since_id=since_id, max_id=max_id,
+                            count=count, result_type='recent')
+    oldest_id = min((tweet.id for tweet in results), default=None)
+
+    tweets = [{'id': tweet.id,
+               'text': tweet.text,
+               'author': tweet.author.screen_name,
+               'retweet_count': tweet.retweet_count,
+               'created_at': tweet.created_at}
+              for tweet in results if not hasattr(tweet, 'retweeted_status')]
+    return tweets, oldest_id
+
+
+def search_tweets(search_text, since_id=None, max_id=None, count=100, client=None):
+    """
+    Searches twitter for statuses with the given search text, excluding retweets.
+    :param search_text: string to search for
+    :param since_id: Optional, only return statuses newer than this ID
+    :param max_id: Optional, only return statuses at or older than this ID
+    :param count: maximum number of statuses to return
+    :param client: Optional tweepy API object, created from the config file if not provided
     :return: list of dicts representing basic tweet info
     """
-    api = twitter_api()
-    results = api.search(q=search_text)
+    return search_page(search_text, since_id, max_id, count, client)[0]
+
 
-    return [{'text': tweet.text,
-             'author': tweet.author.screen_name,
-             'retweet_count': tweet.retweet_count,
-             'created_at': tweet.created_at}
-            for tweet in results if not hasattr(tweet, 'retweeted_status')]
+def search_budget(client=None):
+    """
+    Gets the number of search requests left in the current twitter rate limit window.
+    :param client: Optional tweepy API object, created from the config file if not provided
+    :return: int
+    """
+    client = client or twitter_api()
+    status = client.rate_limit_status(resources='search')
+    return status['resources']['search']['/search/tweets']['remaining']
+
+
+def transactions(lg, known_keys=(), page_size=25):
+    """
+    Gets the league's transactions, newest first, stopping at the first one already known.
+    :param lg: object representing the league resource from Yahoo API
+    :param known_keys: collection of transaction keys already held
+    :param page_size: number of transactions to request at a time
+    :return: list of dicts, each with transaction details and a list of the players moved
+    """
+    ret = []
+    start = 0
+    while True:
+        api_response = lg.yhandler.get(f'league/{lg.league_id}/transactions;start={start};count={page_size}')
+        transaction_set = api_response['fantasy_content']['league'][1]['transactions']
+        if not transaction_set:
+            return ret
+
+        for key, val in transaction_set.items():
+            if key == 'count':
+                continue
+            details, player_set = val['transaction'][0], val['transaction'][1].get('players', {})
+            if details['transaction_key'] in known_keys:
+                return ret
+
+            moves = []
+            for player_key, player_val in player_set.items():
+                if player_key == 'count':
+                    continue
+                player_details = {}
+                for detail in player_val['player'][0]:
+                    if isinstance(detail, dict):
+                        player_details.update(detail)
+                move = player_val['player'][1]['transaction_data']
+                move = move[0] if isinstance(move, list) else move
+                moves.append({'player_id': player_details['player_id'],
+                              'name': player_details['name']['full'],
+                              'type': move['type'],
+                              'source_team_key': move.get('source_team_key'),
+                              'destination_team_key': move.get('destination_team_key')})
+
+            ret.append({'transaction_key': details['transaction_key'],
+                        'type': details['type'],
+                        'status': details['status'],
+                        'timestamp': int(details['timestamp']),
+                        'players': moves})
+
+        if transaction_set.get('count', 0) < page_size:
+            return ret
+        start += page_size
 
 
 def twitter_api():
@@ -197,4 +356,7 @@ def twitter_api():
     auth = tweepy.OAuthHandler(credentials['consumer_key'], credentials['consumer_secret'])
     auth.set_access_token(credentials['access_key'], credentials['access_secret'])
 
-    return tweepy.API(auth)
+    # tweepy manages its own connections, so apply the shared transport's timeout and retry policy
+    settings = transport.transport()
+    return tweepy.API(auth, timeout=settings.timeout[1], retry_count=settings.retries,
+                      retry_delay=settings.backoff, retry_errors=transport.RETRY_STATUSES)
@@ -3,15 +3,25 @@ Functions for interacting with a sqlite database to support the Fantasy Football
 """
 
 # Standard library imports
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import fnmatch
+import hashlib
 import json
 import logging
+import math
 from pathlib import Path
 import os
+import random
 import re
 import sqlite3
+import tempfile
 
 # Third-party imports
+import numpy as np
+import pandas as pd
 from tqdm import tqdm
 import yaml
 
@@ -24,13 +34,174 @@ with open('_config.yml', 'r') as config_file:
 log = logging.getLogger()
 logging.basicConfig(filename='ffb.log', level=logging.DEBUG)
 
+DATABASE_MODES = ('file', 'memory', 'readonly', 'scratch')
+
+_CROSSWALK = None
+_DATABASE = dict(CONFIG.get('database') or {})
+_SHARED_CONN = None
+
+
+class PlayerIds:
+    """
+    The IDs each data source uses for one player, plus the details most often needed with them.
+    """
+    __slots__ = ('nfl_id', 'esbid', 'gsis_id', 'yahoo_id', 'nfl_name', 'yahoo_name', 'eligible_positions')
+
+    def __init__(self, nfl_id, esbid, gsis_id, yahoo_id, nfl_name, yahoo_name, eligible_positions):
+        self.nfl_id = nfl_id
+        self.esbid = esbid
+        self.gsis_id = gsis_id
+        self.yahoo_id = yahoo_id
+        self.nfl_name = nfl_name
+        self.yahoo_name = yahoo_name
+        self.eligible_positions = eligible_positions
+
+    def __repr__(self):
+        return f'PlayerIds(nfl_id={self.nfl_id!r}, yahoo_id={self.yahoo_id!r}, name={self.nfl_name!r})'
+
+
+class Crosswalk:
+    """
+    In-memory map between the NFL, ESB, GSIS and Yahoo IDs of every player in the database.
+    """
+    id_types = ('nfl_id', 'esbid', 'gsis_id', 'yahoo_id')
+
+    def __init__(self, players, version):
+        """
+        :param players: list of PlayerIds
+        :param version: database ID and data version of the database the players were read from
+        """
+        self.players = players
+        self.version = version
+        self.index = {id_type: {} for id_type in self.id_types}
+        for player in players:
+            for id_type, ids in self.index.items():
+                player_id = getattr(player, id_type)
+                if player_id is not None:
+                    ids[str(player_id)] = player
+
+    def by_position(self, position):
+        """
+        Gets every player eligible at a position.
+        :param position: position code e.g. QB
+        :return: list of PlayerIds
+        """
+        return [player for player in self.players if position in (player.eligible_positions or '')]
+
+    def convert(self, player_id, from_type, to_type):
+        """
+        Translates a player ID from one source to another.
+        :param player_id: the known ID
+        :param from_type: one of nfl_id, esbid, gsis_id, yahoo_id
+        :param to_type: one of nfl_id, esbid, gsis_id, yahoo_id
+        :return: the requested ID, or None if the player isn't known
+        """
+        player = self.lookup(from_type, player_id)
+        return getattr(player, to_type) if player else None
+
+    def lookup(self, id_type, player_id):
+        """
+        Finds a player by any of their IDs.
+        :param id_type: one of nfl_id, esbid, gsis_id, yahoo_id
+        :param player_id: the ID, as a string or int
+        :return: PlayerIds, or None if the player isn't known
+        """
+        return self.index[id_type].get(str(player_id))
+
+
+class RunningStats:
+    """
+    Distribution of one player's weekly points in a season - count, sum, mean, variance (Welford),
+    min, max and a histogram for approximate quantiles - that can be updated a week at a time.
+    """
+    __slots__ = ('n', 'total', 'mean', 'm2', 'min_points', 'max_points', 'histogram')
+    # one-point histogram bins from -10 up to 70, with anything outside going in the end bins
+    bin_start = -10
+    bin_count = 80
+
+    def __init__(self, n=0, total=0.0, mean=0.0, m2=0.0, min_points=None, max_points=None,
+                 histogram=None):
+        self.n = n
+        self.total = total
+        self.mean = mean
+        self.m2 = m2
+        self.min_points = min_points
+        self.max_points = max_points
+        self.histogram = array('H', bytes(2 * self.bin_count))
+        if histogram:
+            self.histogram = array('H')
+            self.histogram.frombytes(histogram)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['n'], row['total'], row['mean'], row['m2'], row['min_points'],
+                   row['max_points'], row['histogram'])
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else None
+
+    def add(self, points):
+        self.n += 1
+        self.total += points
+        delta = points - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (points - self.mean)
+        self.min_points = points if self.min_points is None else min(self.min_points, points)
+        self.max_points = points if self.max_points is None else max(self.max_points, points)
+        self.histogram[self._bin(points)] += 1
+
+    def remove(self, points):
+        """
+        Takes a previously added week back out, e.g. when a stat correction replaces it.
+        :param points: the points originally added
+        :return: False if the min or max was removed and needs recalculating, otherwise True
+        """
+        if self.n <= 1:
+            self.__init__()
+            return True
+
+        mean = (self.n * self.mean - points) / (self.n - 1)
+        self.m2 = max(self.m2 - (points - self.mean) * (points - mean), 0.0)
+        self.mean = mean
+        self.n -= 1
+        self.total -= points
+        self.histogram[self._bin(points)] -= 1
+        return self.min_points < points < self.max_points
+
+    def quantile(self, q):
+        """
+        Estimates a quantile from the histogram, to within a point.
+        :param q: quantile between 0 and 1 e.g. 0.5 for the median
+        :return: float, or None if there are no weeks
+        """
+        if not self.n:
+            return None
+
+        target = q * self.n
+        cumulative = 0
+        for i, count in enumerate(self.histogram):
+            if count and cumulative + count >= target:
+                estimate = self.bin_start + i + (target - cumulative) / count
+                return min(max(estimate, self.min_points), self.max_points)
+            cumulative += count
+        return self.max_points
+
+    def to_row(self, player_nfl_id, season):
+        return (player_nfl_id, season, self.n, self.total, self.mean, self.variance, self.m2,
+                self.min_points, self.max_points, self.quantile(0.25), self.quantile(0.5),
+                self.quantile(0.75), self.histogram.tobytes())
+
+    def _bin(self, points):
+        return min(max(math.floor(points - self.bin_start), 0), self.bin_count - 1)
+
 
 def build_database():
     """
     Reconstructs the player, stat and game database from scratch.
     """
-    db_path = Path('F:/Databases/nfl/players.db')
-    journal_path = db_path/'-journal'
+    db_path = database_path()
+    journal_path = db_path.with_name(db_path.name + '-journal')
     if db_path.exists() or journal_path.exists():
         raise RuntimeError('Remove or rename existing database file(s) before proceeding.')
 
@@ -39,19 +210,157 @@ def build_database():
     load_nfl_game_data()
 
 
+def bump_data_version(conn):
+    """
+    Marks the database as changed, so cached query results from before the change are not reused.
+    Call from any function that writes to tables read by cached queries, before committing. The
+    database ID changes too, so a copy that has diverged (e.g. in 'memory' mode) can't reach the
+    same data version as the file it came from and share its cached results.
+    :param conn: sqlite connection that made the changes
+    :return: the new data version
+    """
+    version = data_version(conn) + 1
+    conn.execute(f'PRAGMA user_version = {version}')
+    _stamp_database_id(conn)
+    return version
+
+
+def cached_query(sql, params=()):
+    """
+    Runs a query, reusing the stored result if the same query has already been run against the
+    current version of the same database. Results are kept as compressed data frames in the query cache
+    folder, which is trimmed back to its size limit (oldest used first) whenever a result is added.
+    :param sql: query string
+    :param params: tuple of query parameters
+    :return: pandas data frame
+    """
+    conn, curs = connect()
+    version = f'{database_id(conn)}-{data_version(conn)}'
+
+    # collapse whitespace outside string literals, so formatting changes don't miss the cache
+    parts = re.split(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""", sql)
+    normalised = ''.join(part if i % 2 else ' '.join(part.split()) for i, part in enumerate(parts))
+    key = hashlib.sha1(repr((normalised, tuple(params))).encode('utf-8')).hexdigest()
+
+    cache_dir = Path(CONFIG.get('query_cache_dir', 'cache'))
+    cache_file = cache_dir/f'{key}-{version}.pkl.gz'
+    try:
+        df = pd.read_pickle(cache_file)
+        cache_file.touch()
+        return df
+    except FileNotFoundError:
+        # not cached yet, or just trimmed by another process
+        pass
+
+    df = query_frame(sql, params)
+    for col in df.select_dtypes(include='integer').columns:
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for stale_file in cache_dir.glob(f'{key}-*.pkl.gz'):
+        _remove_cache_file(stale_file)
+    # written under a temporary name first, so other processes never read a partial file
+    fd, temp_name = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    df.to_pickle(temp_name, compression='gzip')
+    os.replace(temp_name, cache_file)
+    trim_query_cache(cache_dir, CONFIG.get('query_cache_mb', 256))
+
+    return df
+
+
 def connect():
     """
-    Connects to the database containing player and stat info.
+    Connects to the database containing player and stat info. How depends on the database mode (see
+    use_database): 'file' and 'readonly' open a new connection to the database file each time, while
+    'memory' and 'scratch' hand out one in-memory connection shared by the whole process.
     :return: connection and cursor objects
     """
-    db_path = os.path.normpath('F:/databases/nfl/players.db')
-    conn = sqlite3.connect(db_path)
+    global _SHARED_CONN
+    mode = _DATABASE.get('mode', 'file')
+    if mode not in DATABASE_MODES:
+        raise ValueError(f'Database mode must be one of {", ".join(DATABASE_MODES)}.')
+
+    if mode == 'file':
+        conn = sqlite3.connect(os.path.normpath(database_path()))
+    elif mode == 'readonly':
+        conn = sqlite3.connect(f'{database_path().resolve().as_uri()}?mode=ro', uri=True)
+    elif _SHARED_CONN is not None:
+        conn = _SHARED_CONN
+    else:
+        conn = sqlite3.connect(':memory:', check_same_thread=False)
+        if mode == 'memory':
+            disk_conn = sqlite3.connect(f'{database_path().resolve().as_uri()}?mode=ro', uri=True)
+            disk_conn.backup(conn)
+            disk_conn.close()
+            log.info(f'Loaded {database_path()} into memory')
+        _SHARED_CONN = conn
+
+    if mode != 'readonly' and not _database_id(conn):
+        _stamp_database_id(conn)
+
     # conn.set_trace_callback(print)
     conn.row_factory = dict_factory
     curs = conn.cursor()
     return conn, curs
 
 
+def crosswalk():
+    """
+    Gets the player ID crosswalk, loading it from the database on first use and again whenever the
+    data version shows the database has changed (or a different database is in use) since it was loaded.
+    :return: Crosswalk
+    """
+    global _CROSSWALK
+    conn, curs = connect()
+    version = (database_id(conn), data_version(conn))
+    if _CROSSWALK is None or _CROSSWALK.version != version:
+        rows = curs.execute('''SELECT nfl_id, esbid, gsisPlayerId, yahoo_id,
+                              nfl_name, yahoo_name, eligible_positions
+                              FROM player''').fetchall()
+        players = [PlayerIds(row['nfl_id'], row['esbid'], row['gsisPlayerId'], row['yahoo_id'],
+                             row['nfl_name'], row['yahoo_name'], row['eligible_positions'])
+                   for row in rows]
+        _CROSSWALK = Crosswalk(players, version)
+    return _CROSSWALK
+
+
+def database_id(conn):
+    """
+    Gets the random ID stamped into the database, which tells apart databases (or diverged copies
+    of one) whose data versions happen to match. A read-only database that has never been opened
+    for writing has no ID, so is identified by its path instead.
+    :param conn: sqlite connection
+    :return: str
+    """
+    return str(_database_id(conn) or hashlib.sha1(str(database_path().resolve()).encode('utf-8')).hexdigest())
+
+
+def _database_id(conn):
+    curs = conn.cursor()
+    curs.row_factory = None
+    return curs.execute('PRAGMA application_id').fetchone()[0]
+
+
+def database_path():
+    """
+    Gets the location of the database file, from the database path config setting.
+    :return: Path
+    """
+    return Path(_DATABASE.get('path', 'F:/databases/nfl/players.db'))
+
+
+def data_version(conn):
+    """
+    Gets the version number of the data, which increases whenever ingestion changes the database.
+    :param conn: sqlite connection
+    :return: int
+    """
+    curs = conn.cursor()
+    curs.row_factory = None
+    return curs.execute('PRAGMA user_version').fetchone()[0]
+
+
 def dict_factory(cursor, row):
     """
     Makes sqlite return an indexable dict of results rather than a tuple.
@@ -64,6 +373,165 @@ def dict_factory(cursor, row):
     return d
 
 
+def current_free_agents(league_id=None):
+    """
+    Gets the free agent pool as of the latest stored snapshot.
+    :param league_id: Yahoo league ID, defaults to the league in the config file
+    :return: list of dicts with player details and when they became available
+    """
+    _, curs = connect()
+    return curs.execute('''SELECT e.yahoo_id, e.name, e.eligible_positions,
+                             e.observed_at, e.season, e.week
+                             FROM free_agent_event e
+                             INNER JOIN (SELECT MAX(id) as id FROM free_agent_event
+                                         WHERE league_id = ?
+                                         GROUP BY yahoo_id) latest ON e.id = latest.id
+                             WHERE e.event = 'add'
+                             ''', (league_id or CONFIG['league_id'],)).fetchall()
+
+
+def free_agents_added_since(since, league_id=None):
+    """
+    Finds players currently in the free agent pool who joined it at or after a given time.
+    :param since: datetime or ISO 8601 UTC string
+    :param league_id: Yahoo league ID, defaults to the league in the config file
+    :return: list of dicts with player details and when they became available
+    """
+    _, curs = connect()
+    if isinstance(since, datetime):
+        since = since.astimezone(timezone.utc).isoformat(timespec='seconds')
+    return curs.execute('''SELECT e.yahoo_id, e.name, e.eligible_positions,
+                             e.observed_at, e.season, e.week
+                             FROM free_agent_event e
+                             INNER JOIN (SELECT MAX(id) as id FROM free_agent_event
+                                         WHERE league_id = ?
+                                         GROUP BY yahoo_id) latest ON e.id = latest.id
+                             WHERE e.event = 'add' AND e.observed_at >= ?
+                             ORDER BY e.observed_at DESC''',
+                        (league_id or CONFIG['league_id'], since)).fetchall()
+
+
+def free_agent_points_since_available(league_id=None):
+    """
+    Totals the points scored by each current free agent since they became available.
+    :param league_id: Yahoo league ID, defaults to the league in the config file
+    :return: list of dicts with player details, when they became available and points since then
+    """
+    _, curs = connect()
+    return curs.execute('''SELECT e.yahoo_id, e.name, e.eligible_positions, e.observed_at,
+                             count(pwp.points) as weeks, coalesce(sum(pwp.points), 0) as points
+                             FROM free_agent_event e
+                             INNER JOIN (SELECT MAX(id) as id FROM free_agent_event
+                                         WHERE league_id = ?
+                                         GROUP BY yahoo_id) latest ON e.id = latest.id
+                             LEFT JOIN player ON player.yahoo_id = e.yahoo_id
+                             LEFT JOIN player_weekly_points pwp
+                                ON pwp.player_nfl_id = player.nfl_id
+                                AND (pwp.season > e.season
+                                     OR (pwp.season = e.season AND pwp.week >= e.week))
+                             WHERE e.event = 'add'
+                             GROUP BY e.id
+                             ORDER BY points DESC''', (league_id or CONFIG['league_id'],)).fetchall()
+
+
+def ingest_tweets(watchlist, client=None, budget=None, count=100, max_pages=5):
+    """
+    Fetches new tweets for each search in a watchlist and stores them, skipping any already held.
+    Each search pages back until a page comes back empty, and only then asks later runs for just
+    the statuses newer than the last one stored for it (search can return short pages while older
+    statuses remain). A search cut short by max_pages or the budget saves where it got to, and the next run carries on
+    paging back from there before moving on to newer statuses. Every search gets a first page before
+    any search gets a second, and no more requests are made than the rate limit (or budget, if
+    lower) allows.
+    :param watchlist: iterable of search strings, e.g. player names
+    :param client: Optional tweepy API object, created from the config file if not provided
+    :param budget: Optional maximum number of search requests to make
+    :param count: number of statuses per request
+    :param max_pages: maximum number of requests per search in one run
+    :return: number of new tweets stored
+    """
+    conn, curs = connect()
+    curs.execute('''CREATE TABLE IF NOT EXISTS tweet (
+                    id INTEGER PRIMARY KEY,
+                    text TEXT,
+                    author TEXT,
+                    retweet_count INTEGER,
+                    created_at TEXT)''')
+    curs.execute('''CREATE TABLE IF NOT EXISTS tweet_match (
+                    query TEXT,
+                    tweet_id INTEGER,
+                    PRIMARY KEY (query, tweet_id))''')
+    curs.execute('''CREATE TABLE IF NOT EXISTS tweet_search (
+                    query TEXT PRIMARY KEY,
+                    since_id INTEGER,
+                    max_id INTEGER,
+                    newest_id INTEGER,
+                    searched_at TEXT)''')
+    columns = {row['name'] for row in curs.execute('PRAGMA table_info(tweet_search)').fetchall()}
+    for column in ['max_id', 'newest_id']:
+        if column not in columns:
+            curs.execute(f'ALTER TABLE tweet_search ADD COLUMN {column} INTEGER')
+    conn.commit()
+
+    client = client or api.twitter_api()
+    remaining = api.search_budget(client)
+    if budget is not None:
+        remaining = min(remaining, budget)
+
+    # max_id is where an unfinished search left off, and newest_id the newest status it had seen
+    rows = curs.execute('SELECT query, since_id, max_id, newest_id FROM tweet_search').fetchall()
+    since_ids = {row['query']: row['since_id'] for row in rows}
+    max_ids = {row['query']: row['max_id'] for row in rows}
+    newest_ids = {row['query']: row['newest_id'] for row in rows if row['newest_id'] is not None}
+
+    new_tweets = 0
+    searches = deque((query, max_ids.get(query), 1) for query in dict.fromkeys(watchlist))
+    while searches and remaining > 0:
+        query, max_id, page = searches.popleft()
+        tweets, oldest_id = api.search_page(query, since_id=since_ids.get(query), max_id=max_id,
+                                            count=count, client=client)
+        remaining -= 1
+
+        if tweets:
+            before = conn.total_changes
+            curs.executemany('''INSERT OR IGNORE INTO tweet
+                                (id, text, author, retweet_count, created_at)
+                                VALUES
+                                (?, ?, ?, ?, ?)''',
+                             [(t['id'], t['text'], t['author'], t['retweet_count'], str(t['created_at']))
+                              for t in tweets])
+            new_tweets += conn.total_changes - before
+            curs.executemany('INSERT OR IGNORE INTO tweet_match (query, tweet_id) VALUES (?, ?)',
+                             [(query, t['id']) for t in tweets])
+            conn.commit()
+            newest_ids[query] = max(newest_ids.get(query, 0), max(t['id'] for t in tweets))
+
+        if oldest_id is not None:
+            # there may be older unseen statuses until a page comes back empty - come back for them,
+            # this run if max_pages allows, otherwise next run
+            next_max_id = oldest_id - 1
+            if page < max_pages:
+                searches.append((query, next_max_id, page + 1))
+            else:
+                _save_tweet_search(curs, query, since_ids.get(query), next_max_id, newest_ids.get(query))
+                conn.commit()
+            continue
+
+        # search caught up, so later runs can start from the newest status seen
+        if query in newest_ids or max_ids.get(query) is not None:
+            _save_tweet_search(curs, query, newest_ids.get(query, since_ids.get(query)), None, None)
+            conn.commit()
+
+    if searches:
+        log.info(f'Search budget used up with {len(searches)} search(es) outstanding')
+        for query, max_id, page in searches:
+            if page > 1:
+                _save_tweet_search(curs, query, since_ids.get(query), max_id, newest_ids.get(query))
+        conn.commit()
+
+    return new_tweets
+
+
 def latest_game_data():
     _, curs = connect()
     row = curs.execute('''SELECT season, week FROM weekstat
@@ -75,7 +543,11 @@ def latest_game_data():
 def load_nfl_game_data():
     """
     Runs through every stat file in the data folder and uploads the weekly player/game data to the
-    database.
+    database. A manifest records each file's size, modification time, content hash and row count:
+    unchanged files are skipped without touching weekstat, and a changed file (e.g. republished
+    with stat corrections) replaces its whole season-week in a single transaction. Each week is
+    therefore either fully loaded or untouched, so an interrupted run resumes where it stopped.
+    :return: list of (season, week) tuples loaded
     """
     conn, curs = connect()
     curs.execute('''CREATE TABLE IF NOT EXISTS weekstat (
@@ -85,32 +557,500 @@ def load_nfl_game_data():
                     week INTEGER,
                     stat_nfl_id TEXT,
                     stat_vol REAL)''')
+    # covering index, so weekstat doubles as an inverted index from stat to the players recording it
+    curs.execute('''CREATE INDEX IF NOT EXISTS weekstat_stat
+                    ON weekstat (stat_nfl_id, season, week, player_nfl_id, stat_vol)''')
+    curs.execute('CREATE INDEX IF NOT EXISTS weekstat_week ON weekstat (season, week)')
+    curs.execute('''CREATE TABLE IF NOT EXISTS ingest_manifest (
+                    path TEXT PRIMARY KEY,
+                    season INTEGER,
+                    week INTEGER,
+                    size INTEGER,
+                    mtime REAL,
+                    sha256 TEXT,
+                    row_count INTEGER,
+                    loaded_at TEXT)''')
     conn.commit()
 
+    manifest = {row['path']: row for row in curs.execute('SELECT * FROM ingest_manifest').fetchall()}
+    # points and their distributions can only be kept up to date once they have been built in full
+    incremental = _table_exists(curs, 'statline') and _table_exists(curs, 'player_season_stats')
+
     folder = Path('data_in')
-    stat_files = folder.glob('*weekstats*.json')
+    stat_files = sorted(folder.glob('*weekstats*.json'))
+    loaded = []
 
     for stat_file in tqdm(stat_files):
+        file_stat = stat_file.stat()
+        entry = manifest.get(stat_file.as_posix())
+        if entry and entry['size'] == file_stat.st_size and entry['mtime'] == file_stat.st_mtime:
+            continue
+
+        content = stat_file.read_bytes()
+        sha256 = hashlib.sha256(content).hexdigest()
+        if entry and entry['sha256'] == sha256:
+            # file was rewritten with identical contents
+            curs.execute('UPDATE ingest_manifest SET mtime = ? WHERE path = ?',
+                         (file_stat.st_mtime, stat_file.as_posix()))
+            conn.commit()
+            continue
+
         season = re.split('[-.]', stat_file.stem)[2]
         week = re.split('[-.]', stat_file.stem)[3]
-        row = curs.execute('''SELECT * FROM weekstat
-                              WHERE season = ? and week = ?
-                              LIMIT 1''', (season, week)).fetchone()
-        if row:
+        players = json.loads(content)['games']['102019']['players']
+        params = [(player_id, int(season), int(week), k, v)
+                  for player_id, player_stats in players.items()
+                  for k, v in player_stats['stats']['week'][season][week].items()]
+
+        with conn:
+            curs.execute('DELETE FROM weekstat WHERE season = ? AND week = ?', (int(season), int(week)))
+            curs.executemany('''INSERT INTO weekstat
+                                (player_nfl_id, season, week, stat_nfl_id, stat_vol)
+                                VALUES
+                                (?, ?, ?, ?, ?)''', params)
+            curs.execute('''INSERT OR REPLACE INTO ingest_manifest
+                            (path, season, week, size, mtime, sha256, row_count, loaded_at)
+                            VALUES
+                            (?, ?, ?, ?, ?, ?, ?, ?)''',
+                         (stat_file.as_posix(), int(season), int(week), file_stat.st_size,
+                          file_stat.st_mtime, sha256, len(params),
+                          datetime.now(timezone.utc).isoformat(timespec='seconds')))
+            if incremental:
+                _update_week_points(curs, int(season), int(week))
+            bump_data_version(conn)
+        log.info(f'Loaded {len(params)} stat rows for {season} week {week} from {stat_file}')
+        loaded.append((int(season), int(week)))
+
+    if loaded and incremental:
+        calc_player_rolling_points()
+    elif loaded and _table_exists(curs, 'statline'):
+        calc_player_weekly_points()
+
+    return loaded
+
+
+def players_by_stat(nfl_stat_id, period='week', season=None, weeks=None, position=None,
+                    min_volume=None):
+    """
+    Finds every player who recorded a particular stat, using the weekstat_stat index.
+    :param nfl_stat_id: ID of the stat per the NFL Fantasy API
+    :param period: 'week' for one row per player-week, 'season' for totals per player-season
+    :param season: Optional season to restrict to, otherwise all seasons are searched
+    :param weeks: Optional tuple of first and last week to include
+    :param position: Optional position code e.g. QB
+    :param min_volume: Optional minimum stat volume, per week or per season depending on period
+    :return: pandas data frame, highest volume first
+    """
+    if period not in ('week', 'season'):
+        raise ValueError('Period must be "week" or "season".')
+
+    conditions = ['w.stat_nfl_id = ?']
+    params = [str(nfl_stat_id)]
+    if season is not None:
+        conditions.append('w.season = ?')
+        params.append(season)
+    if weeks is not None:
+        conditions.append('w.week BETWEEN ? AND ?')
+        params.extend(weeks)
+    if position is not None:
+        conditions.append('player.eligible_positions LIKE ?')
+        params.append(f'%{position}%')
+
+    if period == 'week':
+        if min_volume is not None:
+            conditions.append('w.stat_vol >= ?')
+            params.append(min_volume)
+        sql = f'''SELECT player.nfl_name, player.eligible_positions, w.season, w.week,
+                   w.stat_vol as volume
+                   FROM weekstat w LEFT JOIN player ON player.nfl_id = w.player_nfl_id
+                   WHERE {' AND '.join(conditions)}
+                   ORDER BY volume DESC, w.season, w.week'''
+    else:
+        having = ''
+        if min_volume is not None:
+            having = 'HAVING volume >= ?'
+            params.append(min_volume)
+        sql = f'''SELECT player.nfl_name, player.eligible_positions, w.season,
+                   count(*) as weeks, sum(w.stat_vol) as volume
+                   FROM weekstat w LEFT JOIN player ON player.nfl_id = w.player_nfl_id
+                   WHERE {' AND '.join(conditions)}
+                   GROUP BY w.player_nfl_id, w.season
+                   {having}
+                   ORDER BY volume DESC, w.season'''
+
+    return query_frame(sql, tuple(params))
+
+
+def query_columns(sql, params=(), dtypes=None):
+    """
+    Runs a query and returns the results column by column as NumPy arrays, without building a dict
+    for every row. Columns holding only numbers (and NULLs) become int or float arrays, anything
+    else an object array.
+    :param sql: query string
+    :param params: tuple of query parameters
+    :param dtypes: Optional dict of NumPy dtypes for particular columns
+    :return: dict of arrays keyed by column name, in query order
+    """
+    conn, _ = connect()
+    curs = conn.cursor()
+    curs.row_factory = None
+    rows = curs.execute(sql, params).fetchall()
+    names = [col[0] for col in curs.description]
+    values = zip(*rows) if rows else [()] * len(names)
+
+    dtypes = dtypes or {}
+    return {name: _column_array(column, dtypes.get(name)) for name, column in zip(names, values)}
+
+
+def query_frame(sql, params=(), dtypes=None):
+    """
+    Runs a query and returns the results as a data frame built from typed column arrays. Use this
+    rather than the dict rows from connect() for anything bigger than a small lookup.
+    :param sql: query string
+    :param params: tuple of query parameters
+    :param dtypes: Optional dict of NumPy dtypes for particular columns
+    :return: pandas data frame
+    """
+    columns = query_columns(sql, params, dtypes)
+    return pd.DataFrame(columns, columns=list(columns))
+
+
+def _column_array(values, dtype=None):
+    """
+    Converts one column of query results to an array, picking the narrowest type that holds it.
+    :param values: tuple of values from sqlite
+    :param dtype: Optional NumPy dtype to use instead of inferring one
+    :return: NumPy array
+    """
+    if dtype is not None:
+        return np.array(values, dtype=dtype)
+
+    types = set(map(type, values))
+    if types == {int}:
+        return np.array(values, dtype=np.int64)
+    if types and types <= {int, float, type(None)} and types != {type(None)}:
+        return np.array(values, dtype=np.float64)
+    return np.array(values, dtype=object)
+
+
+def _remove_cache_file(path):
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        # already removed by another process sharing the cache
+        pass
+
+
+def _save_tweet_search(curs, query, since_id, max_id, newest_id):
+    curs.execute('''INSERT OR REPLACE INTO tweet_search (query, since_id, max_id, newest_id, searched_at)
+                    VALUES (?, ?, ?, ?, ?)''',
+                 (query, since_id, max_id, newest_id, datetime.now(timezone.utc).isoformat(timespec='seconds')))
+
+
+def _stamp_database_id(conn):
+    conn.execute(f'PRAGMA application_id = {random.randint(1, 2 ** 31 - 1)}')
+
+
+def sync_roster_positions(lg=None):
+    """
+    Stores the number of each roster slot (QB, WR, W/R/T, BN etc.) in the league.
+    :param lg: Optional league object from the Yahoo API
+    :return: dict of slot counts keyed by position
+    """
+    conn, curs = connect()
+    curs.execute('''CREATE TABLE IF NOT EXISTS league_roster_position (
+                    league_id TEXT,
+                    position TEXT,
+                    count INTEGER,
+                    PRIMARY KEY (league_id, position))''')
+
+    lg = lg or api.league()
+    positions = {position: int(details['count']) for position, details in lg.positions().items()}
+    with conn:
+        curs.executemany('''INSERT OR REPLACE INTO league_roster_position (league_id, position, count)
+                            VALUES (?, ?, ?)''',
+                         [(lg.league_id, position, count) for position, count in positions.items()])
+    return positions
+
+
+def sync_rosters(include_current=True, max_workers=8, lg=None):
+    """
+    Stores every team's weekly roster and selected positions, requesting only weeks newer than the
+    last one stored after it was complete - so a week first stored while in progress is fetched
+    again once it has finished. Team-weeks are requested concurrently.
+    :param include_current: also refresh the current week, whose lineups can still change
+    :param max_workers: maximum number of rosters to request from the Yahoo API at once
+    :param lg: Optional league object from the Yahoo API
+    :return: list of weeks stored
+    """
+    conn, curs = connect()
+    curs.execute('''CREATE TABLE IF NOT EXISTS roster_slot (
+                    league_id TEXT,
+                    season INTEGER,
+                    week INTEGER,
+                    team_key TEXT,
+                    yahoo_id TEXT,
+                    name TEXT,
+                    selected_position TEXT,
+                    eligible_positions TEXT,
+                    final INTEGER DEFAULT 0,
+                    PRIMARY KEY (league_id, week, team_key, yahoo_id))''')
+    if 'final' not in {row['name'] for row in curs.execute('PRAGMA table_info(roster_slot)').fetchall()}:
+        # rosters stored before weeks were marked final are all fetched again
+        curs.execute('ALTER TABLE roster_slot ADD COLUMN final INTEGER DEFAULT 0')
+    curs.execute('''CREATE INDEX IF NOT EXISTS roster_slot_player
+                    ON roster_slot (league_id, yahoo_id, week)''')
+    conn.commit()
+
+    lg = lg or api.league()
+    current_week = lg.current_week()
+    row = curs.execute('''SELECT max(week) as week FROM roster_slot
+                          WHERE league_id = ? AND week < ? AND final = 1''',
+                       (lg.league_id, current_week)).fetchone()
+    weeks = list(range((row['week'] or 0) + 1, current_week))
+    if include_current:
+        weeks.append(current_week)
+    if not weeks:
+        return weeks
+
+    season = int(lg.settings()['season'])
+    team_keys = [team['team_key'] for team in lg.teams()]
+    team_weeks = [(team_key, week) for week in weeks for team_key in team_keys]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        rosters = executor.map(lambda team_week: lg.to_team(team_week[0]).roster(week=team_week[1]),
+                               team_weeks)
+        params = [(lg.league_id, season, week, team_key, str(player['player_id']), player['name'],
+                   player['selected_position'], ','.join(player['eligible_positions']), int(week < current_week))
+                  for (team_key, week), roster in zip(team_weeks, rosters) for player in roster]
+
+    with conn:
+        curs.executemany('DELETE FROM roster_slot WHERE league_id = ? AND week = ? AND team_key = ?',
+                         [(lg.league_id, week, team_key) for team_key, week in team_weeks])
+        curs.executemany('''INSERT INTO roster_slot
+                            (league_id, season, week, team_key, yahoo_id, name, selected_position,
+                             eligible_positions, final)
+                            VALUES
+                            (?, ?, ?, ?, ?, ?, ?, ?, ?)''', params)
+    if any(week < current_week for week in weeks):
+        # stored with finished rosters, so each season's lineups can be solved after its league has finished
+        sync_roster_positions(lg)
+    log.info(f'Stored rosters for week(s) {weeks}')
+    return weeks
+
+
+def sync_transactions():
+    """
+    Stores the league's adds, drops and trades, requesting only those newer than the latest stored.
+    :return: number of new transactions stored
+    """
+    conn, curs = connect()
+    curs.execute('''CREATE TABLE IF NOT EXISTS league_transaction (
+                    transaction_key TEXT PRIMARY KEY,
+                    league_id TEXT,
+                    type TEXT,
+                    status TEXT,
+                    timestamp INTEGER)''')
+    curs.execute('''CREATE TABLE IF NOT EXISTS transaction_player (
+                    transaction_key TEXT,
+                    yahoo_id TEXT,
+                    name TEXT,
+                    type TEXT,
+                    source_team_key TEXT,
+                    destination_team_key TEXT,
+                    PRIMARY KEY (transaction_key, yahoo_id))''')
+    curs.execute('''CREATE INDEX IF NOT EXISTS league_transaction_time
+                    ON league_transaction (league_id, timestamp)''')
+    curs.execute('CREATE INDEX IF NOT EXISTS transaction_player_id ON transaction_player (yahoo_id)')
+    conn.commit()
+
+    lg = api.league()
+    rows = curs.execute('''SELECT transaction_key FROM league_transaction
+                          WHERE league_id = ?
+                          ORDER BY timestamp DESC
+                          LIMIT 50''', (lg.league_id,)).fetchall()
+    new_transactions = api.transactions(lg, known_keys={row['transaction_key'] for row in rows})
+
+    with conn:
+        curs.executemany('''INSERT OR REPLACE INTO league_transaction
+                            (transaction_key, league_id, type, status, timestamp)
+                            VALUES
+                            (?, ?, ?, ?, ?)''',
+                         [(t['transaction_key'], lg.league_id, t['type'], t['status'], t['timestamp'])
+                          for t in new_transactions])
+        curs.executemany('''INSERT OR REPLACE INTO transaction_player
+                            (transaction_key, yahoo_id, name, type, source_team_key, destination_team_key)
+                            VALUES
+                            (?, ?, ?, ?, ?, ?)''',
+                         [(t['transaction_key'], str(p['player_id']), p['name'], p['type'],
+                           p['source_team_key'], p['destination_team_key'])
+                          for t in new_transactions for p in t['players']])
+    log.info(f'Stored {len(new_transactions)} new transaction(s)')
+    return len(new_transactions)
+
+
+def _table_exists(curs, table):
+    row = curs.execute('SELECT name FROM sqlite_master WHERE type = "table" AND name = ?', (table,)).fetchone()
+    return row is not None
+
+
+def team_roster(team_key, week, league_id=None):
+    """
+    Gets a team's stored roster for a week, in the same form as the Yahoo API's team roster.
+    :param team_key: Yahoo team key
+    :param week: int for the fantasy week
+    :param league_id: Yahoo league ID, defaults to the league in the config file
+    :return: list of dicts of player_id, name, selected_position and eligible_positions, empty if the
+             week hasn't been stored since it finished
+    """
+    _, curs = connect()
+    if not _table_exists(curs, 'roster_slot'):
+        return []
+    rows = curs.execute('''SELECT yahoo_id as player_id, name, selected_position, eligible_positions
+                          FROM roster_slot
+                          WHERE league_id = ? AND week = ? AND team_key = ? AND final = 1''',
+                        (league_id or CONFIG['league_id'], week, team_key)).fetchall()
+    for row in rows:
+        row['eligible_positions'] = row['eligible_positions'].split(',') if row['eligible_positions'] else []
+    return rows
+
+
+def trim_query_cache(cache_dir, max_mb):
+    """
+    Deletes the least recently used cached query results until the cache fits its size limit.
+    :param cache_dir: Path of the query cache folder
+    :param max_mb: size limit in megabytes
+    :return: nothing
+    """
+    cache_files = []
+    for path in cache_dir.glob('*.pkl.gz'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            # removed by another process since the folder was listed
             continue
+        cache_files.append((stat.st_mtime, stat.st_size, path))
+    cache_files.sort()
 
-        with open(stat_file, 'r') as f:
-            stats = json.loads(f.read())
-            players = stats['games']['102019']['players']
-            for player_id, player_stats in tqdm(players.items()):
-                stats = player_stats['stats']['week'][season][week]
-                for k, v in stats.items():
-                    params = (player_id, season, week, k, v)
-                    curs.execute('''INSERT INTO weekstat
-                                    (player_nfl_id, season, week, stat_nfl_id, stat_vol)
-                                    VALUES
-                                    (?, ?, ?, ?, ?)''', params)
-            conn.commit()
+    total_size = sum(size for _, size, _ in cache_files)
+    while cache_files and total_size > max_mb * 1024 * 1024:
+        _, size, oldest = cache_files.pop(0)
+        total_size -= size
+        _remove_cache_file(oldest)
+
+
+def tweet_watchlist():
+    """
+    Builds a list of player names to follow on twitter: everyone on a team in the league, plus the
+    latest free agent pool.
+    :return: list of quoted player names, ready to use as search strings
+    """
+    lg = api.league()
+    team_keys = [team['team_key'] for team in lg.teams()]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        rosters = executor.map(lambda team_key: lg.to_team(team_key).roster(), team_keys)
+        names = [player['name'] for roster in rosters for player in roster]
+
+    names += [player['name'] for player in current_free_agents(lg.league_id)]
+    return [f'"{name}"' for name in dict.fromkeys(names)]
+
+
+def use_database(mode=None, path=None):
+    """
+    Switches database for the rest of the process. The default comes from the database section of
+    the config file. Modes are:
+     - 'file' (default): read and write the database file directly
+     - 'memory': copy the whole database file into memory for a fast analysis session - changes
+       are lost unless saved with save_database()
+     - 'readonly': open the file read-only, so many analysis processes can share it safely
+     - 'scratch': an empty, throwaway in-memory database, e.g. for tests and benchmarks
+    :param mode: one of the modes above, or None to leave unchanged
+    :param path: Optional location of the database file
+    :return: nothing
+    """
+    global _SHARED_CONN, _CROSSWALK
+    if mode is not None and mode not in DATABASE_MODES:
+        raise ValueError(f'Database mode must be one of {", ".join(DATABASE_MODES)}.')
+
+    if _SHARED_CONN is not None:
+        _SHARED_CONN.close()
+        _SHARED_CONN = None
+    _CROSSWALK = None
+
+    if mode is not None:
+        _DATABASE['mode'] = mode
+    if path is not None:
+        _DATABASE['path'] = str(path)
+
+
+def save_database(path=None):
+    """
+    Writes the in-memory database back to a file, when in 'memory' or 'scratch' mode. A scratch
+    database is never written over the configured database file.
+    :param path: file to write to, defaults to the database path in 'memory' mode but required in
+                 'scratch' mode
+    :return: nothing
+    """
+    if _SHARED_CONN is None:
+        raise RuntimeError('No in-memory database to save.')
+    if _DATABASE.get('mode') == 'scratch':
+        if path is None:
+            raise ValueError('A scratch database needs an explicit path to save to.')
+        if Path(path).resolve() == database_path().resolve():
+            raise ValueError(f'Refusing to overwrite {database_path()} with a scratch database.')
+    disk_conn = sqlite3.connect(os.path.normpath(path or database_path()))
+    _SHARED_CONN.backup(disk_conn)
+    disk_conn.close()
+
+
+def update_free_agent_pool():
+    """
+    Snapshots the league's free agent pool, storing only the players added to or dropped from it
+    since the previous snapshot.
+    :return: tuple of sets of Yahoo IDs added to and dropped from the pool
+    """
+    conn, curs = connect()
+    curs.execute('''CREATE TABLE IF NOT EXISTS free_agent_event (
+                    id INTEGER PRIMARY KEY,
+                    league_id TEXT,
+                    yahoo_id TEXT,
+                    name TEXT,
+                    eligible_positions TEXT,
+                    event TEXT,
+                    observed_at TEXT,
+                    season INTEGER,
+                    week INTEGER)''')
+    curs.execute('''CREATE INDEX IF NOT EXISTS free_agent_event_player
+                    ON free_agent_event (league_id, yahoo_id, id)''')
+    curs.execute('''CREATE INDEX IF NOT EXISTS free_agent_event_time
+                    ON free_agent_event (league_id, observed_at)''')
+    conn.commit()
+
+    lg = api.league()
+    pool = api.free_agent_pool(lg)
+    previous_pool = {row['yahoo_id'] for row in current_free_agents(lg.league_id)}
+
+    added = pool.keys() - previous_pool
+    dropped = previous_pool - pool.keys()
+    if not added and not dropped:
+        return added, dropped
+
+    observed_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    season = int(lg.settings()['season'])
+    week = lg.current_week()
+
+    params = [(lg.league_id, yahoo_id, pool[yahoo_id]['name'],
+               ','.join(pool[yahoo_id]['eligible_positions']), 'add', observed_at, season, week)
+              for yahoo_id in added]
+    params += [(lg.league_id, yahoo_id, None, None, 'drop', observed_at, season, week)
+               for yahoo_id in dropped]
+    curs.executemany('''INSERT INTO free_agent_event
+                        (league_id, yahoo_id, name, eligible_positions, event, observed_at, season, week)
+                        VALUES
+                        (?, ?, ?, ?, ?, ?, ?, ?)''', params)
+    conn.commit()
+    log.info(f'Free agent pool: {len(added)} added, {len(dropped)} dropped')
+
+    return added, dropped
 
 
 def update_player_data():
@@ -133,6 +1073,8 @@ def update_player_data():
                             yahoo_name text,
                             yahoo_id text,
                             eligible_positions text)''')
+    curs.execute('CREATE INDEX IF NOT EXISTS player_nfl_id ON player (nfl_id)')
+    curs.execute('CREATE INDEX IF NOT EXISTS player_yahoo_id ON player (yahoo_id)')
 
     # add missing players from the NFL stat data
     for player in player_stats:
@@ -228,15 +1170,16 @@ def update_player_data():
                             WHERE id = ?''', (new_id, dst['id']))
         conn.commit()
 
+    bump_data_version(conn)
+    conn.commit()
+
 
 def update_stats_data():
     """
     Adds new stat types to the database.
     :return: nothing
     """
-    db_path = os.path.normpath('F:/databases/nfl/players.db')
-    conn = sqlite3.connect(db_path)
-    curs = conn.cursor()
+    conn, curs = connect()
     curs.execute('''CREATE TABLE IF NOT EXISTS statline (
                         id integer PRIMARY KEY,
                         nfl_name text,
@@ -267,15 +1210,214 @@ def update_stats_data():
                                 );""", vals)
         conn.commit()
 
+    bump_data_version(conn)
+    conn.commit()
+
+
+def update_team_projections(max_workers=8):
+    """
+    Stores projected and actual points for every team in each completed week not already in the
+    database. One scoreboard call covers all teams in a week, and missing weeks are fetched
+    concurrently.
+    :param max_workers: maximum number of weeks to request from the Yahoo API at once
+    :return: nothing
+    """
+    conn, curs = connect()
+    curs.execute('''CREATE TABLE IF NOT EXISTS team_weekly_projection (
+                    league_id TEXT,
+                    team_key TEXT,
+                    week INTEGER,
+                    proj_points REAL,
+                    act_points REAL,
+                    PRIMARY KEY (league_id, team_key, week))''')
+    conn.commit()
+
+    lg = api.league()
+    rows = curs.execute('''SELECT DISTINCT week FROM team_weekly_projection
+                          WHERE league_id = ?''', (lg.league_id,)).fetchall()
+    stored_weeks = {row['week'] for row in rows}
+    missing_weeks = [week for week in range(1, lg.current_week()) if week not in stored_weeks]
+
+    if not missing_weeks:
+        return
+
+    log.info(f'Fetching projections for week(s) {missing_weeks}')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for week_points in executor.map(lambda week: api.scoreboard_points(lg, week), missing_weeks):
+            params = [(lg.league_id, d['team_key'], d['week'], d['proj_points'], d['act_points'])
+                      for d in week_points]
+            curs.executemany('''INSERT OR REPLACE INTO team_weekly_projection
+                                (league_id, team_key, week, proj_points, act_points)
+                                VALUES
+                                (?, ?, ?, ?, ?)''', params)
+            conn.commit()
+
 
 def calc_player_weekly_points():
+    """
+    Rebuilds every player's weekly points from weekstat, along with the per-season distributions and
+    rolling form derived from them. After this has run once, load_nfl_game_data keeps all three up
+    to date as weeks are loaded.
+    :return: nothing
+    """
     conn, curs = connect()
     curs.execute('''DROP TABLE IF EXISTS player_weekly_points''')
-    curs.execute('''CREATE TABLE player_weekly_points AS
+    curs.execute('''CREATE TABLE player_weekly_points (
+                    player_nfl_id TEXT,
+                    season INTEGER,
+                    week INTEGER,
+                    points REAL)''')
+    curs.execute('''CREATE INDEX player_weekly_points_week
+                    ON player_weekly_points (season, week)''')
+    curs.execute('''CREATE INDEX player_weekly_points_player
+                    ON player_weekly_points (player_nfl_id, season, week)''')
+    curs.execute('''INSERT INTO player_weekly_points (player_nfl_id, season, week, points)
                     SELECT weekstat.player_nfl_id, weekstat.season, weekstat.week, 
                     sum(weekstat.stat_vol*statline.points) as points
                     FROM weekstat LEFT JOIN statline on weekstat.stat_nfl_id=statline.nfl_id
                     WHERE statline.points IS NOT NULL
                     GROUP BY weekstat.player_nfl_id, weekstat.season, weekstat.week
                     ''')
+    bump_data_version(conn)
+    conn.commit()
+    calc_player_season_stats()
+    calc_player_rolling_points()
+
+
+def calc_player_season_stats():
+    """
+    Rebuilds the distribution of weekly points for every player-season from player_weekly_points.
+    :return: nothing
+    """
+    conn, curs = connect()
+    curs.execute('''DROP TABLE IF EXISTS player_season_stats''')
+    curs.execute('''CREATE TABLE player_season_stats (
+                    player_nfl_id TEXT,
+                    season INTEGER,
+                    n INTEGER,
+                    total REAL,
+                    mean REAL,
+                    variance REAL,
+                    m2 REAL,
+                    min_points REAL,
+                    max_points REAL,
+                    q25 REAL,
+                    median REAL,
+                    q75 REAL,
+                    histogram BLOB,
+                    PRIMARY KEY (player_nfl_id, season))''')
+
+    stats = {}
+    rows = curs.execute('''SELECT player_nfl_id, season, points FROM player_weekly_points
+                          ORDER BY player_nfl_id, season, week''')
+    for row in rows:
+        stats.setdefault((row['player_nfl_id'], row['season']), RunningStats()).add(row['points'])
+
+    _write_season_stats(curs, stats)
+    bump_data_version(conn)
+    conn.commit()
+
+
+def _update_week_points(curs, season, week):
+    """
+    Recalculates player points for one week from weekstat, and applies the difference from any
+    previous points for that week to the players' season distributions. Doesn't commit, so it can
+    share a transaction with the weekstat load.
+    :param curs: sqlite cursor
+    :param season: int season
+    :param week: int week
+    :return: nothing
+    """
+    week_points_sql = 'SELECT player_nfl_id, points FROM player_weekly_points WHERE season = ? AND week = ?'
+    old_points = {row['player_nfl_id']: row['points']
+                  for row in curs.execute(week_points_sql, (season, week)).fetchall()}
+
+    curs.execute('DELETE FROM player_weekly_points WHERE season = ? AND week = ?', (season, week))
+    curs.execute('''INSERT INTO player_weekly_points (player_nfl_id, season, week, points)
+                    SELECT weekstat.player_nfl_id, weekstat.season, weekstat.week, 
+                    sum(weekstat.stat_vol*statline.points) as points
+                    FROM weekstat LEFT JOIN statline on weekstat.stat_nfl_id=statline.nfl_id
+                    WHERE statline.points IS NOT NULL AND weekstat.season = ? AND weekstat.week = ?
+                    GROUP BY weekstat.player_nfl_id, weekstat.season, weekstat.week
+                    ''', (season, week))
+    new_points = {row['player_nfl_id']: row['points']
+                  for row in curs.execute(week_points_sql, (season, week)).fetchall()}
+
+    rows = curs.execute('SELECT * FROM player_season_stats WHERE season = ?', (season,)).fetchall()
+    stats = {row['player_nfl_id']: RunningStats.from_row(row) for row in rows}
+
+    changed = {nfl_id for nfl_id in old_points.keys() | new_points.keys()
+               if old_points.get(nfl_id) != new_points.get(nfl_id)}
+    stale = set()
+    for nfl_id in changed:
+        player_stats = stats.setdefault(nfl_id, RunningStats())
+        if nfl_id in old_points and not player_stats.remove(old_points[nfl_id]):
+            stale.add(nfl_id)
+        if nfl_id in new_points:
+            player_stats.add(new_points[nfl_id])
+
+    for nfl_id in stale:
+        row = curs.execute('''SELECT min(points) as min_points, max(points) as max_points
+                              FROM player_weekly_points
+                              WHERE player_nfl_id = ? AND season = ?''', (nfl_id, season)).fetchone()
+        stats[nfl_id].min_points, stats[nfl_id].max_points = row['min_points'], row['max_points']
+
+    _write_season_stats(curs, {(nfl_id, season): stats[nfl_id] for nfl_id in changed})
+
+
+def _write_season_stats(curs, stats):
+    """
+    Saves player-season distributions, removing any left with no weeks.
+    :param curs: sqlite cursor
+    :param stats: dict of RunningStats keyed by tuples of player NFL ID and season
+    :return: nothing
+    """
+    curs.executemany('''INSERT OR REPLACE INTO player_season_stats
+                        (player_nfl_id, season, n, total, mean, variance, m2, min_points, max_points,
+                         q25, median, q75, histogram)
+                        VALUES
+                        (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                     [player_stats.to_row(*key) for key, player_stats in stats.items() if player_stats.n])
+    curs.executemany('DELETE FROM player_season_stats WHERE player_nfl_id = ? AND season = ?',
+                     [key for key, player_stats in stats.items() if not player_stats.n])
+
+
+def calc_player_rolling_points(window=4):
+    """
+    Precomputes rolling form for every player-week: the mean and variance of points over the last
+    few games played, and the trend (least-squares slope of points per game) across them. The latest
+    row for each player is flagged so current form can be read without scanning history.
+    :param window: number of games in the rolling window
+    :return: nothing
+    """
+    conn, curs = connect()
+    preceding = int(window) - 1
+    curs.execute('''DROP TABLE IF EXISTS player_rolling_points''')
+    curs.execute(f'''CREATE TABLE player_rolling_points AS
+                     WITH games AS (
+                        SELECT player_nfl_id, season, week, points,
+                        ROW_NUMBER() OVER (PARTITION BY player_nfl_id ORDER BY season, week) as x
+                        FROM player_weekly_points),
+                     windowed AS (
+                        SELECT player_nfl_id, season, week,
+                        COUNT(*) OVER w as games,
+                        AVG(points) OVER w as mean_points,
+                        AVG(points * points) OVER w as mean_sq,
+                        AVG(x) OVER w as mean_x,
+                        AVG(x * x) OVER w as mean_xx,
+                        AVG(x * points) OVER w as mean_xy,
+                        ROW_NUMBER() OVER (PARTITION BY player_nfl_id
+                                           ORDER BY season DESC, week DESC) as recency
+                        FROM games
+                        WINDOW w AS (PARTITION BY player_nfl_id ORDER BY x
+                                     ROWS BETWEEN {preceding} PRECEDING AND CURRENT ROW))
+                     SELECT player_nfl_id, season, week, games, mean_points,
+                     MAX(mean_sq - mean_points * mean_points, 0) as var_points,
+                     CASE WHEN mean_xx - mean_x * mean_x > 0
+                          THEN (mean_xy - mean_x * mean_points) / (mean_xx - mean_x * mean_x)
+                          ELSE 0 END as trend,
+                     recency = 1 as latest
+                     FROM windowed''')
+    curs.execute('''CREATE INDEX player_rolling_points_latest
+                    ON player_rolling_points (latest, player_nfl_id)''')
     conn.commit()
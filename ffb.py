@@ -9,6 +9,7 @@ A lot of work left to do, but aims are to:
 """
 
 # standard library imports
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import json
 from pathlib import Path
 import urllib.parse
@@ -17,7 +18,6 @@ import urllib.parse
 import numpy as np
 import pandas as pd
 import plotly.express as px
-import requests
 import yaml
 from matplotlib import pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
@@ -25,15 +25,16 @@ from mpl_toolkits.mplot3d import Axes3D
 # local imports
 import api
 import db
+import similarity
+import transport
 import util
 
 with open('_config.yml', 'r') as config_file:
     CONFIG = yaml.safe_load(config_file)
 
 
-def box_plot(position, top_n):
-    _, curs = db.connect()
-    rows = curs.execute(
+def box_plot(position, top_n, out_file=None):
+    df = db.cached_query(
         '''SELECT player.nfl_name as player_name, season, week, points, t.scoring_rank
            FROM (player_weekly_points LEFT JOIN player on player_weekly_points.player_nfl_id = player.nfl_id)
            LEFT JOIN (SELECT player_nfl_id, RANK () OVER ( ORDER BY SUM(points) Desc ) scoring_rank
@@ -45,11 +46,56 @@ def box_plot(position, top_n):
            WHERE player.eligible_positions = ? AND season = 2019
            GROUP BY player.nfl_name, season, week, points
            HAVING scoring_rank <= ?
-           ORDER BY scoring_rank''', (position, position, top_n)
-        ).fetchall()
-    df = pd.DataFrame(rows)
+           ORDER BY scoring_rank''', (position, position, top_n))
     fig = px.box(df, x='player_name', y='points')
-    fig.show()
+    show_figure(fig, out_file)
+
+
+def build_report(folder='reports', seasons=None, positions=None, yahoo_ids=(), processes=None):
+    """
+    Renders every chart for every position and season to files, without needing a display. Charts
+    are drawn in parallel across a pool of processes.
+    :param folder: directory to write the charts to
+    :param seasons: seasons to chart, defaults to every season in the database
+    :param positions: position groups to chart, defaults to the report_positions config setting
+    :param yahoo_ids: Yahoo IDs of players to chart weekly points history for
+    :param processes: number of worker processes, defaults to the number of CPUs
+    :return: list of files written
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+
+    if seasons is None:
+        _, curs = db.connect()
+        rows = curs.execute('SELECT DISTINCT season FROM player_weekly_points ORDER BY season').fetchall()
+        seasons = [row['season'] for row in rows]
+    positions = positions or CONFIG.get('report_positions', ['QB', 'RB', 'WR', 'TE', 'K', 'DEF'])
+
+    jobs = [('consistency_chart', (frequency,), folder/f'consistency-{frequency}.html')
+            for frequency in ['season', 'week']]
+    for position in positions:
+        jobs.append(('box_plot', (position, 20), folder/f'box-{position}.html'))
+        jobs.append(('correlate_years', (position,), folder/f'correlate-{position}.html'))
+        for season in seasons:
+            jobs.append(('minmax', (position, season), folder/f'minmax-{position}-{season}.html'))
+            jobs.append(('risk_reward', (position, season), folder/f'risk-reward-{position}-{season}.html'))
+            jobs.append(('scoring_breakdown', (position, season),
+                         folder/f'scoring-breakdown-{position}-{season}.html'))
+    for yahoo_id in yahoo_ids:
+        jobs.append(('player_points_history', (yahoo_id,), folder/f'points-history-{yahoo_id}.png'))
+
+    written = []
+    with ProcessPoolExecutor(max_workers=processes, initializer=plt.switch_backend,
+                             initargs=('Agg',)) as executor:
+        futures = {executor.submit(render_chart, *job): job for job in jobs}
+        for future in as_completed(futures):
+            func_name, args, out_file = futures[future]
+            try:
+                written.append(future.result())
+            except Exception as e:
+                print(f'Failed to render {func_name}{args}: {e!r}')
+
+    return written
 
 
 def calc_week_stats(week=None):
@@ -59,6 +105,8 @@ def calc_week_stats(week=None):
     :return: Nothing
     """
     league = api.league()
+    # only finished weeks are served from the database, so the current week isn't worth storing here
+    db.sync_rosters(include_current=False, lg=league)
 
     week = week or league.current_week()
 
@@ -73,14 +121,8 @@ def calc_week_stats(week=None):
         team_missing_multipliers[team['name']] = missing_multipliers
         team_missing_players[team['name']] = missing_players
 
-    api_response = league.matchups(week)
-    week_matchups = api_response['fantasy_content']['league'][1]['scoreboard']['0']['matchups']
     print(f"------ Week {week} ------")
-    for val in week_matchups.values():
-        if isinstance(val, int):
-            continue
-        team1 = val['matchup']['0']['teams']['0']['team'][0][2]['name']
-        team2 = val['matchup']['0']['teams']['1']['team'][0][2]['name']
+    for team1, team2 in api.matchup_teams(league, week):
         team1_score = team_points[team1]
         team2_score = team_points[team2]
         print(f'{team1} {team1_score:.2f} v {team2_score:.2f} {team2}')
@@ -94,83 +136,71 @@ def calc_week_stats(week=None):
             print(f'{team} missing multipiers:', multipliers)
 
 
-def consistency_chart(frequency):
-    _, curs = db.connect()
+def consistency_chart(frequency, out_file=None):
     if frequency == 'season':
-        result = curs.execute('''SELECT player.nfl_name as player_name, season, sum(points) as points
-                                 FROM player_weekly_points 
-                                 LEFT JOIN player on player_weekly_points.player_nfl_id = player.nfl_id
+        df = db.cached_query('''SELECT player.nfl_name as player_name, season, sum(total) as points
+                                 FROM player_season_stats 
+                                 LEFT JOIN player on player_season_stats.player_nfl_id = player.nfl_id
                                  WHERE player.eligible_positions = 'QB'
-                                 GROUP BY player.nfl_name, season''').fetchall()
+                                 GROUP BY player.nfl_name, season''')
         x_data = 'season'
         x_axis_ticks = dict(tickmode='array', tickvals=[2015, 2016, 2017, 2018, 2019],
                             ticktext=['2015', '2016', '2017', '2018', '2019'])
 
     elif frequency == 'week':
-        result = curs.execute('''SELECT player.nfl_name as player_name, season, week, 
+        df = db.cached_query('''SELECT player.nfl_name as player_name, season, week, 
                                  (season || "-" || week) as game, points
                                  FROM player_weekly_points 
                                  LEFT JOIN player on player_weekly_points.player_nfl_id = player.nfl_id
-                                 WHERE player.eligible_positions = "QB"''').fetchall()
+                                 WHERE player.eligible_positions = "QB"''')
         x_data = 'game'
     else:
         raise ValueError('Frequency must be "season" or "week".')
 
-    df = pd.DataFrame(result)
-    fig = px.line(df, x=x_data, y='points', line_group='player_name', color='player_name')
+    fig = px.line(df, x=x_data, y='points', line_group='player_name', color='player_name',
+                  render_mode='webgl')
 
     if frequency == 'season':
         fig.update_layout(xaxis=x_axis_ticks)
     else:
         fig.update_layout(xaxis_tickformat='%m<br>%Y')
 
-    fig.show()
+    show_figure(fig, out_file)
 
 
-def correlate_years(position):
+def correlate_years(position, out_file=None):
     """
     Charts players total points across two years.
     :param position: string representing position e.g. WR
+    :param out_file: Optional path to write the chart to, instead of showing it
     :return: Nothing
     """
-    _, curs = db.connect()
-    result = curs.execute('''SELECT player.nfl_name as player_name, season, sum(points)
-                             FROM player_weekly_points 
-                             LEFT JOIN player on player_weekly_points.player_nfl_id = player.nfl_id
-                             WHERE player.eligible_positions = ?
-                             GROUP BY player.nfl_name, season''', (position, )).fetchall()
+    df = db.cached_query('''SELECT player.nfl_name as player_name, season, sum(points)
+                            FROM player_weekly_points 
+                            LEFT JOIN player on player_weekly_points.player_nfl_id = player.nfl_id
+                            WHERE player.eligible_positions = ?
+                            GROUP BY player.nfl_name, season''', (position, ))
 
-    df = pd.DataFrame(result)
     df = df.pivot(index='player_name', columns='season', values='sum(points)').reset_index()
     df = df.fillna(0)
 
-    fig = px.scatter(df, x=2018, y=2019, text='player_name')
+    fig = px.scatter(df, x=2018, y=2019, text='player_name', render_mode='webgl')
     fig.update_traces(textposition='top center')
-    fig.show()
+    show_figure(fig, out_file)
 
 
 def evaluate_predictions():
     """
-    Gets player predictions for each available week and compares with predicted points.
+    Compares projected and actual points for each team in every completed week. Weeks not yet stored
+    locally are fetched first, so repeat runs only query the database.
     :return: nothing
     """
-    week_limit = api.league().current_week()
-    teams = api.league().teams()
-    points_list = []
-    for team in teams:
-        team_obj = api.league().to_team(team['team_key'])
-        for week in range(1, week_limit):
-            d = {}
-            matchup = team_obj.matchup(week)
-            points = matchup[0]['0']['teams']['0']['team'][1]
-            d['team_id'] = team['team_key']
-            d['week'] = week
-            d['proj_points'] = float(points['team_projected_points']['total'])
-            d['act_points'] = float(points['team_points']['total'])
-
-            points_list.append(d)
-
-    df = pd.DataFrame(points_list)
+    db.update_team_projections()
+
+    df = db.query_frame('''SELECT team_key as team_id, week, proj_points, act_points
+                           FROM team_weekly_projection
+                           WHERE league_id = ?
+                           ORDER BY team_key, week''', (CONFIG['league_id'],))
     df['residual'] = df['act_points'] - df['proj_points']
     fig, axs = plt.subplots(nrows=1, ncols=2)
 
@@ -182,54 +212,40 @@ def evaluate_predictions():
     plt.show()
 
 
-def find_players_by_score_type(nfl_score_id, period):
+def find_players_by_score_type(nfl_score_id, period='week', season=None, weeks=None, position=None,
+                               min_volume=None):
     """
     Prints a table of all players who recorded particular box score stats.
     :param nfl_score_id: The ID of the requested stat per the NFL Fantasy API
-    :param period: "season" for the whole season, otherwise just uses 2019 week 10
-    :return:
+    :param period: "season" for totals per player-season, otherwise one row per player-week
+    :param season: Optional season to search, otherwise all seasons are searched
+    :param weeks: Optional tuple of first and last week to include e.g. (1, 8)
+    :param position: Optional string representing a position group e.g. QB
+    :param min_volume: Optional minimum volume of the stat recorded
+    :return: pandas data frame of the players found
     """
-    if period == 'season':
-        score_file = Path('data_in/nfl-seasonstats-2019-10.json')
-    else:
-        score_file = Path('data_in/nfl-weekstats-2019-10.json')
-
-    with open(score_file, 'r') as f:
-        week_stats = json.load(f)
-
-    filtered = [i for i in week_stats['players'] if nfl_score_id in i['stats'].keys()]
-
-    for player in filtered:
-        attr_to_show = [player['name'], player['teamAbbr'], player['position'], player['stats'][nfl_score_id]]
-
-        print('\t'.join(attr_to_show))
+    df = db.players_by_stat(nfl_score_id, period, season, weeks, position, min_volume)
+    print(df.to_string(index=False))
+    return df
 
 
-def minmax(position):
+def minmax(position, season=2019, out_file=None):
     """
-    Plots the best and worst weekly rankings for each player in the specified position group.
+    Plots the best, worst and median weekly scores for each player in the specified position group,
+    read from the precomputed season distributions.
     :param position: str, 2 letters representing position group e.g. QB
+    :param season: integer season e.g. 2019
+    :param out_file: Optional path to write the chart to, instead of showing it
     :return: Nothing
     """
-    unused_conn, curs = db.connect()
-    players = curs.execute('SELECT * FROM player WHERE eligible_positions = ?', (position,))
-
-    df_players = pd.DataFrame(players)
-    df_ranks = pd.concat([position_rankings(position, 2019, week, False) for week in range(1, 18)])
-
-    df = df_players.merge(right=df_ranks, how='inner', on='nfl_id')
-    df.to_csv('output.csv')
-    df = df[['week', 'rank', 'nfl_name']]
-    df = df.sort_values(['week', 'rank'])
-    df = df.pivot(index='nfl_name', columns='week', values='rank').reset_index()
-    weeks = [i for i in range(1, 18)]
-    df['games_played'] = df[weeks].count(axis=1)
-    df['worst'] = df[weeks].max(axis=1)
-    df['best'] = df[weeks].min(axis=1)
-    df['median'] = df[weeks].median(axis=1)
+    df = db.query_frame('''SELECT player.nfl_name, s.n as games_played, s.max_points as best,
+                           s.min_points as worst, s.median
+                           FROM player_season_stats s
+                           INNER JOIN player on s.player_nfl_id = player.nfl_id
+                           WHERE player.eligible_positions = ? AND s.season = ?''', (position, season))
 
     fig2 = px.scatter_3d(df, x='best', y='worst', z='median', text='nfl_name', color='games_played')
-    fig2.show()
+    show_figure(fig2, out_file)
 
 
 def points_from_scores(score_dict):
@@ -262,13 +278,10 @@ def points_from_scores(score_dict):
     return points, missing_multipliers
 
 
-def player_points_history(yahoo_id):
-    _, curs = db.connect()
-    rows = curs.execute('''SELECT p.season, p.week, p.points FROM player_weekly_points as p
+def player_points_history(yahoo_id, out_file=None):
+    df = db.query_frame('''SELECT p.season, p.week, p.points FROM player_weekly_points as p
                            LEFT JOIN player on p.player_nfl_id = player.nfl_id
-                           WHERE player.yahoo_id = ?''', (yahoo_id,)).fetchall()
-
-    df = pd.DataFrame(rows)
+                           WHERE player.yahoo_id = ?''', (yahoo_id,))
 
     season_start = df['season'].min()
     season_end = df['season'].max()
@@ -285,7 +298,11 @@ def player_points_history(yahoo_id):
     plt.bar(x=df['game'], height=df['points'])
     locs, _ = plt.xticks()
     plt.xticks(locs, labels=df['week'])
-    plt.show()
+    if out_file:
+        plt.savefig(out_file)
+        plt.close()
+    else:
+        plt.show()
 
 
 def player_weekly_rankings(*yahoo_ids, plot=True):
@@ -297,10 +314,10 @@ def player_weekly_rankings(*yahoo_ids, plot=True):
     """
 
     league = api.league()
-    unused_conn, curs = db.connect()
+    crosswalk = db.crosswalk()
 
-    query = f'SELECT * FROM player WHERE yahoo_id IN ({",".join("?" * len(yahoo_ids))})'
-    players = curs.execute(query, yahoo_ids).fetchall()
+    players = [crosswalk.lookup('yahoo_id', yahoo_id) for yahoo_id in yahoo_ids]
+    players = [player for player in players if player]
 
     if not players:
         return []
@@ -315,17 +332,17 @@ def player_weekly_rankings(*yahoo_ids, plot=True):
     for player in players:
         player_rankings = []
         for week in range(1, end_week):
-            pos_rank = position_rankings(player['eligible_positions'], 'week', week)
-            stat_row = pos_rank[pos_rank['yahoo_id'] == player['yahoo_id']]
+            pos_rank = position_rankings(player.eligible_positions, 'week', week)
+            stat_row = pos_rank[pos_rank['yahoo_id'] == player.yahoo_id]
             if stat_row.iloc[0]['DNS'] == 1:
                 week_score = np.nan
             else:
                 week_score = stat_row.index.values.astype(int)[0]
             player_rankings.append(week_score)
 
-        rankings[player['yahoo_id']] = player_rankings
+        rankings[player.yahoo_id] = player_rankings
         if plot:
-            ax.plot(player_rankings, label=player['yahoo_name'])
+            ax.plot(player_rankings, label=player.yahoo_name)
 
     if plot:
         box = ax.get_position()
@@ -349,8 +366,10 @@ def position_rankings(position, season, week, season_stats: bool):
     :return: a sorted dataframe of all players in that position for that week
     """
     unused_conn, curs = db.connect()
-    players = curs.execute("""SELECT nfl_id, yahoo_id, yahoo_name FROM player
-                              WHERE eligible_positions LIKE ?""", (f'%{position}%',)).fetchall()
+    players = [{'nfl_id': player.nfl_id, 'yahoo_id': player.yahoo_id, 'yahoo_name': player.yahoo_name}
+               for player in db.crosswalk().by_position(position)]
+    stat_names = {row['nfl_id']: row['nfl_name']
+                  for row in curs.execute('SELECT nfl_id, nfl_name FROM statline').fetchall()}
 
     stat_type = 'season' if season_stats else 'week'
     stats = util.load_stat_file(stat_type, season, week)
@@ -362,8 +381,7 @@ def position_rankings(position, season, week, season_stats: bool):
             player['DNS'] = 1
             continue
         for stat_id, volume in stat_lines.items():
-            stat_name = curs.execute("""SELECT nfl_name FROM statline
-                                        WHERE nfl_id = ?""", (stat_id,)).fetchone()['nfl_name']
+            stat_name = stat_names[stat_id]
             if volume is None:
                 player[stat_name] = 0
             else:
@@ -388,53 +406,58 @@ def position_rankings(position, season, week, season_stats: bool):
     return df
 
 
-def risk_reward(position, season):
+def render_chart(func_name, args, out_file):
+    """
+    Draws a single chart to file. Used as the unit of work for build_report.
+    :param func_name: name of the chart function in this module
+    :param args: tuple of positional arguments for the chart function
+    :param out_file: path to write the chart to
+    :return: the path written
+    """
+    globals()[func_name](*args, out_file=out_file)
+    return out_file
+
+
+def risk_reward(position, season, out_file=None):
     """
     Charts players within a position group by their whole-season rank vs variance in rank.
     :param position: string representing a position group e.g. 'QB'
     :param season: integer season e.g. 2019
+    :param out_file: Optional path to write the chart to, instead of showing it
     :return: Nothing
     """
-    _, curs = db.connect()
-    player_points = curs.execute('''SELECT player.nfl_id, player.yahoo_id, player.yahoo_name,
-                                    player_weekly_points.points
-                                    FROM player LEFT JOIN player_weekly_points 
-                                    ON player.nfl_id=player_weekly_points.player_nfl_id 
-                                    WHERE player.eligible_positions = ? 
-                                    AND player_weekly_points.season = ?
-                                    ''',
-                                 (position, season))
-    df = pd.DataFrame(player_points)
-    df['points'] = df['points'].astype(float)
-    # de minimis threshold
-    df = df[df['points'] >= 5]
-    df = df.groupby(['nfl_id', 'yahoo_id', 'yahoo_name'])['points'].agg([np.sum, np.var])
-    df = df.reset_index()
-    fig = px.scatter(df, x='sum', y='var', text='yahoo_name')
+    df = db.query_frame('''SELECT player.nfl_id, player.yahoo_id, player.yahoo_name,
+                           s.total as sum, s.variance as var
+                           FROM player INNER JOIN player_season_stats s
+                           ON player.nfl_id = s.player_nfl_id
+                           WHERE player.eligible_positions = ? AND s.season = ?
+                           AND s.mean >= 5''', (position, season))
+    fig = px.scatter(df, x='sum', y='var', text='yahoo_name', render_mode='webgl')
     fig.update_traces(textposition='top center')
-    fig.show()
+    show_figure(fig, out_file)
 
 
-def scoring_breakdown(position, season):
+def scoring_breakdown(position, season, out_file=None):
     """
     Charts each player within a position group according to total points scored, broken down by the scoring category.
+    :param position: string representing a position group e.g. 'QB'
+    :param season: integer season e.g. 2019
+    :param out_file: Optional path to write the chart to, instead of showing it
     :return: Nothing
     """
-    _, curs = db.connect()
-    rows = curs.execute("""SELECT player.nfl_name as player, weekstat.season, statline.nfl_name as category, 
-                           sum(weekstat.stat_vol * statline.points) as points
-                           FROM (player INNER JOIN weekstat ON player.nfl_id = weekstat.player_nfl_id)
-                           INNER JOIN statline on weekstat.stat_nfl_id = statline.nfl_id
-                           WHERE player.eligible_positions = ? and weekstat.season = ?
-                           GROUP BY player.nfl_name, weekstat.season, statline.nfl_name""",
-                        (position, season)).fetchall()
+    df = db.cached_query("""SELECT player.nfl_name as player, weekstat.season, statline.nfl_name as category, 
+                            sum(weekstat.stat_vol * statline.points) as points
+                            FROM (player INNER JOIN weekstat ON player.nfl_id = weekstat.player_nfl_id)
+                            INNER JOIN statline on weekstat.stat_nfl_id = statline.nfl_id
+                            WHERE player.eligible_positions = ? and weekstat.season = ?
+                            GROUP BY player.nfl_name, weekstat.season, statline.nfl_name""",
+                         (position, season))
 
-    df = pd.DataFrame(rows)
     df['total_points'] = df.groupby('player').transform(sum)['points']
     df = df[df['points'] != 0].dropna()
     df = df.sort_values(['total_points', 'player', 'points'], ascending=False)
     fig = px.bar(df, x='player', y='points', color='category')
-    fig.show()
+    show_figure(fig, out_file)
 
 
 def scrape_player(p_name):
@@ -447,7 +470,7 @@ def scrape_player(p_name):
     p_name = urllib.parse.quote(p_name)
 
     search_url = f'https://sports.yahoo.com/site/api/resource/searchassist;searchTerm={p_name}'
-    response = requests.get(search_url)
+    response = transport.get(search_url)
 
     if response.status_code != 200:
         return {}
@@ -477,6 +500,20 @@ def scrape_player(p_name):
     return hits[0]['data']
 
 
+def show_figure(fig, out_file=None):
+    """
+    Shows a plotly figure, or writes it to an HTML file if a path is given. Files link to the plotly
+    library rather than embedding it, which keeps batch reports small and quick to write.
+    :param fig: plotly figure
+    :param out_file: Optional path to write the figure to
+    :return: Nothing
+    """
+    if out_file:
+        fig.write_html(str(out_file), include_plotlyjs='cdn')
+    else:
+        fig.show()
+
+
 def team_weekly_score(team, week, league):
     """
     Gets all the scores accrued by a fantasy team for a given week of the league season.
@@ -485,13 +522,14 @@ def team_weekly_score(team, week, league):
     :param league: object representing the league resource from Yahoo API
     :return: dict of scores accrued, and a dict of players not in database or stat file
     """
-    unused_conn, curs = db.connect()
+    crosswalk = db.crosswalk()
     score_file = Path(f'data_in/nfl-weekstats-2019-{week}.json')
     with open(score_file, 'r') as f:
         week_stats = json.load(f)
 
     player_stats = week_stats['games']['102019']['players']
-    roster = league.to_team(team['team_key']).roster(week=week)
+    roster = (db.team_roster(team['team_key'], week, league.league_id)
+              or league.to_team(team['team_key']).roster(week=week))
 
     scores = {}
     missing_players = []
@@ -500,12 +538,10 @@ def team_weekly_score(team, week, league):
         if player['selected_position'] in ['BN', 'IR']:
             continue
 
-        qry_result = curs.execute('''SELECT nfl_id
-                                     FROM player 
-                                     WHERE yahoo_id = ?''', (player['player_id'],)).fetchone()
+        player_ids = crosswalk.lookup('yahoo_id', player['player_id'])
 
-        if qry_result:
-            nfl_id = qry_result['nfl_id']
+        if player_ids:
+            nfl_id = player_ids.nfl_id
         else:
             txt = f'{player["name"]} (not in database using yahoo_id {player["player_id"]})'
             missing_players.append(txt)
@@ -528,7 +564,48 @@ def team_weekly_score(team, week, league):
     return scores, missing_players
 
 
+def waiver_pickups(position=None, season=None, weights=(1.0, 0.5, 0.5), top_n=25):
+    """
+    Ranks every player in the latest free agent pool on recent form, trend and consistency, taken
+    from the rolling aggregates in player_rolling_points. Each measure is standardised within its
+    position group so players in different positions can share one list.
+    :param position: Optional string representing a position group e.g. QB
+    :param season: season to take form from, defaults to the latest in the database
+    :param weights: weights for form, trend and consistency respectively
+    :param top_n: number of players to return
+    :return: pandas data frame of free agents, best pickup first
+    """
+    free_agents = pd.DataFrame(db.current_free_agents())
+    form = db.query_frame('''SELECT player.yahoo_id, r.season, r.week, r.games,
+                             r.mean_points, r.var_points, r.trend
+                             FROM player_rolling_points r
+                             INNER JOIN player ON r.player_nfl_id = player.nfl_id
+                             WHERE r.latest = 1 AND player.yahoo_id IS NOT NULL''')
+    if free_agents.empty or form.empty:
+        return pd.DataFrame()
+
+    season = season or form['season'].max()
+    free_agents = free_agents[['yahoo_id', 'name', 'eligible_positions', 'observed_at']]
+    df = free_agents.merge(form[form['season'] == season], on='yahoo_id', how='inner')
+    df['position'] = df['eligible_positions'].str.split(',').str[0]
+    if position:
+        df = df[df['eligible_positions'].str.split(',').apply(lambda positions: position in positions)]
+
+    df['consistency'] = -np.sqrt(df['var_points'])
+    metrics = ['mean_points', 'trend', 'consistency']
+    groups = df.groupby('position')[metrics]
+    z_scores = (df[metrics] - groups.transform('mean')) / groups.transform('std').replace(0, np.nan)
+    df['score'] = z_scores.fillna(0).to_numpy() @ np.asarray(weights, dtype=float)
+
+    df = df.sort_values('score', ascending=False).head(top_n)
+    df = df.reset_index(drop=True)
+    df.index = range(1, len(df) + 1)
+    return df
+
+
 if __name__ == '__main__':
     # db.calc_player_weekly_points()
-    db.load_nfl_game_data()
+    loaded_weeks = db.load_nfl_game_data()
+    if loaded_weeks:
+        similarity.update_index({season for season, _ in loaded_weeks})
 
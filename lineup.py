@@ -0,0 +1,195 @@
+"""
+Hindsight lineup analysis: works out the best legal lineup each team could have started each week, and
+how many points were left on the bench.
+"""
+
+# standard library imports
+import logging
+
+# third party imports
+import numpy as np
+import pandas as pd
+
+# local imports
+import db
+
+log = logging.getLogger()
+logging.basicConfig(filename='ffb.log', level=logging.DEBUG)
+
+# roster slots that don't score
+NON_STARTING = {'BN', 'IR', 'IL', 'NA'}
+# letters used in flex slots such as W/R/T
+FLEX_LETTERS = {'Q': 'QB', 'W': 'WR', 'R': 'RB', 'T': 'TE', 'K': 'K'}
+
+
+def bench_points(league_ids=None):
+    """
+    Solves every stored team-week and totals the points each team left on the bench.
+    :param league_ids: Optional list of Yahoo league IDs, defaults to every league with stored rosters
+    :return: data frame of points scored, possible and left on the bench by team and season
+    """
+    df = hindsight_lineups(league_ids)
+    if df.empty:
+        return df
+    df = df.groupby(['team_key', 'season'])[['actual_points', 'optimal_points', 'points_left']].sum()
+    return df.reset_index().sort_values('points_left', ascending=False)
+
+
+def eligible_for_slot(eligible_positions, slot):
+    """
+    Checks whether a player can fill a roster slot.
+    :param eligible_positions: list of the player's eligible positions e.g. ['RB', 'W/R/T']
+    :param slot: roster slot e.g. 'RB' or 'W/R/T'
+    :return: bool
+    """
+    if slot in eligible_positions:
+        return True
+    return '/' in slot and any(FLEX_LETTERS.get(letter) in eligible_positions for letter in slot.split('/'))
+
+
+def hindsight_lineups(league_ids=None):
+    """
+    Finds the best lineup for every stored team-week, and compares it with the lineup started. Yahoo
+    league IDs change each season, so every stored league is solved by default, each with its own
+    roster slots. Only weeks stored after they finished are included, and points come from
+    player_weekly_points, so the rosters need syncing first (db.sync_rosters).
+    :param league_ids: Optional list of Yahoo league IDs, defaults to every league with stored rosters
+    :return: data frame of actual and optimal points, and the optimal lineup, for each team-week
+    """
+    rosters = db.query_frame('''SELECT league_id, season, week, team_key, yahoo_id, name, selected_position,
+                                eligible_positions
+                                FROM roster_slot
+                                WHERE final = 1
+                                ORDER BY league_id, season, week, team_key''')
+    if league_ids is not None:
+        rosters = rosters[rosters['league_id'].isin([str(league_id) for league_id in league_ids])]
+    if rosters.empty:
+        return pd.DataFrame()
+
+    crosswalk = db.crosswalk()
+    rosters['player_nfl_id'] = [crosswalk.convert(yahoo_id, 'yahoo_id', 'nfl_id') for yahoo_id in rosters['yahoo_id']]
+    seasons = sorted(rosters['season'].unique())
+    points = db.query_frame(f'''SELECT player_nfl_id, season, week, points FROM player_weekly_points
+                                WHERE season IN ({",".join("?" * len(seasons))})''',
+                            tuple(int(season) for season in seasons))
+    rosters = rosters.merge(points, how='left', on=['player_nfl_id', 'season', 'week'])
+    rosters['points'] = rosters['points'].fillna(0)
+
+    frames = []
+    for league_id, league_rosters in rosters.groupby('league_id', sort=False):
+        slots = starting_slots(league_id)
+        if not slots:
+            log.warning(f'No roster positions stored for league {league_id}, skipping its lineups')
+            continue
+        frames.append(_league_hindsight(league_rosters.reset_index(drop=True), slots))
+
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def _league_hindsight(rosters, slots):
+    """
+    Solves every team-week of one league in a single batch.
+    :param rosters: data frame of the league's roster slots, with each player's points
+    :param slots: dict of starting slot counts keyed by position
+    :return: data frame of actual and optimal points, and the optimal lineup, for each team-week
+    """
+    # lay the rosters out as a (team-week, player) grid for the solver
+    team_week = rosters.groupby(['season', 'week', 'team_key'], sort=True)
+    rows = team_week.ngroup().to_numpy()
+    cols = team_week.cumcount().to_numpy()
+    n_rosters, n_players = rows.max() + 1, cols.max() + 1
+
+    grid_points = np.zeros((n_rosters, n_players))
+    grid_points[rows, cols] = rosters['points'].to_numpy(dtype=float)
+
+    eligibility = {positions: [eligible_for_slot((positions or '').split(','), slot) for slot in slots]
+                   for positions in rosters['eligible_positions'].unique()}
+    grid_eligible = np.zeros((n_rosters, n_players, len(slots)), dtype=bool)
+    grid_eligible[rows, cols] = np.array([eligibility[positions] for positions in rosters['eligible_positions']],
+                                         dtype=bool).reshape(-1, len(slots))
+
+    optimal, assignment = solve(grid_points, grid_eligible, np.array(list(slots.values())))
+
+    slot_names = np.array(list(slots) + ['BN'])
+    rosters['optimal_slot'] = slot_names[assignment[rows, cols]]
+    rosters['started'] = ~rosters['selected_position'].isin(NON_STARTING)
+    rosters['started_points'] = rosters['points'] * rosters['started']
+
+    df = team_week['started_points'].sum().rename('actual_points').reset_index()
+    df.insert(0, 'league_id', rosters['league_id'].iloc[0])
+    df['optimal_points'] = optimal
+    df['points_left'] = df['optimal_points'] - df['actual_points']
+    df['optimal_lineup'] = (rosters[rosters['optimal_slot'] != 'BN']
+                            .groupby(['season', 'week', 'team_key'])['name']
+                            .agg(', '.join)
+                            .reindex(pd.MultiIndex.from_frame(df[['season', 'week', 'team_key']]))
+                            .to_numpy())
+    return df
+
+
+def solve(points, eligible, capacities):
+    """
+    Finds the highest scoring legal lineup for a batch of rosters at once. A dynamic programme runs
+    over players, with the state being how many of each slot type are filled, and every roster in
+    the batch is updated together for each player and slot type.
+    :param points: 2D array of points, one row per roster, one column per player (zero padded)
+    :param eligible: 3D bool array of whether each player can fill each slot type
+    :param capacities: array of the number of each slot type in a lineup
+    :return: array of optimal points per roster, and 2D array of the slot type index each player
+             fills in the optimal lineup (len(capacities) for bench)
+    """
+    n_rosters, n_players = points.shape
+    n_slots = len(capacities)
+
+    # number the states in mixed radix, one digit per slot type
+    strides = np.cumprod(np.concatenate([[1], capacities[:-1] + 1])).astype(int)
+    n_states = int(np.prod(capacities + 1))
+    filled = (np.arange(n_states)[:, None] // strides) % (capacities + 1)
+    open_states = [np.flatnonzero(filled[:, slot] < capacities[slot]) for slot in range(n_slots)]
+
+    best = np.full((n_rosters, n_states), -np.inf)
+    best[:, 0] = 0
+    choices = np.full((n_players, n_rosters, n_states), n_slots, dtype=np.int8)
+    for player in range(n_players):
+        updated = best.copy()
+        for slot in range(n_slots):
+            rows = np.flatnonzero(eligible[:, player, slot])
+            if not len(rows):
+                continue
+            source = open_states[slot]
+            target = source + strides[slot]
+            candidate = best[np.ix_(rows, source)] + points[rows, player, None]
+            better = candidate > updated[np.ix_(rows, target)]
+            updated[np.ix_(rows, target)] = np.where(better, candidate, updated[np.ix_(rows, target)])
+            choices[player][np.ix_(rows, target)] = np.where(better, slot, choices[player][np.ix_(rows, target)])
+        best = updated
+
+    state = best.argmax(axis=1)
+    optimal = best[np.arange(n_rosters), state]
+
+    assignment = np.full((n_rosters, n_players), n_slots, dtype=int)
+    for player in reversed(range(n_players)):
+        slot = choices[player][np.arange(n_rosters), state]
+        assignment[:, player] = slot
+        state = state - np.where(slot < n_slots, strides[np.minimum(slot, n_slots - 1)], 0)
+
+    return optimal, assignment
+
+
+def starting_slots(league_id):
+    """
+    Gets a league's starting roster slots. If they aren't stored yet, those of the league in the
+    config file are synced from the Yahoo API; other leagues must have been synced while current.
+    :param league_id: Yahoo league ID
+    :return: dict of slot counts keyed by position, excluding bench and injury slots, empty if unknown
+    """
+    _, curs = db.connect()
+    rows = []
+    if db._table_exists(curs, 'league_roster_position'):
+        rows = curs.execute('SELECT position, count FROM league_roster_position WHERE league_id = ?',
+                            (league_id,)).fetchall()
+    positions = {row['position']: row['count'] for row in rows}
+    if not positions and str(league_id) == str(db.CONFIG['league_id']):
+        positions = db.sync_roster_positions()
+    return {position: count for position, count in positions.items()
+            if position not in NON_STARTING and count}
@@ -0,0 +1,203 @@
+"""
+Live in-game scoring. Polls the NFL weekstats feed during games and keeps every fantasy matchup score
+up to date by applying only the stat changes for rostered players since the previous poll.
+"""
+
+# standard library imports
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+from pathlib import Path
+import threading
+import time
+
+# third party imports
+import yaml
+
+# local imports
+import api
+import db
+import transport
+
+with open('_config.yml', 'r') as config_file:
+    CONFIG = yaml.safe_load(config_file)
+
+log = logging.getLogger()
+logging.basicConfig(filename='ffb.log', level=logging.DEBUG)
+
+WEEKSTATS_URL = 'https://api.fantasy.nfl.com/v2/players/weekstats'
+
+
+class LiveScoreboard:
+    """
+    Running matchup scores for one fantasy week, updated from successive weekstats snapshots.
+    """
+
+    def __init__(self, season, week, team_players, matchups, multipliers):
+        """
+        :param season: int season e.g. 2019
+        :param week: int for the fantasy week
+        :param team_players: dict of team name to the NFL IDs of its starting players
+        :param matchups: list of tuples of two team names
+        :param multipliers: dict of points per unit for each NFL stat ID
+        """
+        self.season = str(season)
+        self.week = f'{week:02}'
+        self.matchups = matchups
+        self.multipliers = multipliers
+        self.team_points = {team: 0.0 for team in team_players}
+        self.player_stats = {}
+
+        self.owners = {}
+        for team, nfl_ids in team_players.items():
+            for nfl_id in nfl_ids:
+                self.owners.setdefault(str(nfl_id), []).append(team)
+
+    def apply(self, snapshot):
+        """
+        Updates team totals from a weekstats snapshot. Only rostered players are looked at, and
+        only those whose stat line differs from the previous snapshot cost more than a comparison.
+        :param snapshot: dict of the weekstats feed, as returned by the NFL Fantasy API
+        :return: set of names of teams whose score changed
+        """
+        players = next(iter(snapshot['games'].values()))['players']
+
+        changed = set()
+        for nfl_id, teams in self.owners.items():
+            try:
+                stats = players[nfl_id]['stats']['week'][self.season][self.week]
+            except KeyError:
+                continue
+
+            previous = self.player_stats.get(nfl_id, {})
+            if stats == previous:
+                continue
+            self.player_stats[nfl_id] = stats
+
+            delta = sum((float(stats.get(k) or 0) - float(previous.get(k) or 0)) * self.multipliers.get(k, 0)
+                        for k in stats.keys() | previous.keys() if k != 'pts')
+            if delta:
+                for team in teams:
+                    self.team_points[team] += delta
+                    changed.add(team)
+
+        return changed
+
+    def scores(self):
+        """
+        :return: list of tuples of team name, score, opponent score and opponent name
+        """
+        return [(team1, self.team_points[team1], self.team_points[team2], team2)
+                for team1, team2 in self.matchups]
+
+
+def build_scoreboard(league, week):
+    """
+    Sets up a live scoreboard from the starting lineups and matchups for a week.
+    :param league: object representing the league resource from Yahoo API
+    :param week: int for the chosen fantasy week
+    :return: LiveScoreboard
+    """
+    crosswalk = db.crosswalk()
+    teams = league.teams()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        rosters = list(executor.map(lambda team: league.to_team(team['team_key']).roster(week=week), teams))
+
+    team_players = {}
+    for team, roster in zip(teams, rosters):
+        nfl_ids = []
+        for player in roster:
+            if player['selected_position'] in ['BN', 'IR']:
+                continue
+            nfl_id = crosswalk.convert(player['player_id'], 'yahoo_id', 'nfl_id')
+            if nfl_id is None:
+                log.warning(f'{player["name"]} not in database using yahoo_id {player["player_id"]}')
+                continue
+            nfl_ids.append(nfl_id)
+        team_players[team['name']] = nfl_ids
+
+    _, curs = db.connect()
+    multipliers = {row['nfl_id']: row['points'] or 0
+                   for row in curs.execute('SELECT nfl_id, points FROM statline').fetchall()}
+
+    season = int(league.settings()['season'])
+    return LiveScoreboard(season, week, team_players, api.matchup_teams(league, week), multipliers)
+
+
+def print_scores(scoreboard):
+    print(f'------ Week {scoreboard.week} ({time.strftime("%H:%M:%S")}) ------')
+    for team1, team1_score, team2_score, team2 in scoreboard.scores():
+        print(f'{team1} {team1_score:.2f} v {team2_score:.2f} {team2}')
+
+
+def replay_server(snapshot_files, host='127.0.0.1', port=0):
+    """
+    Starts a local HTTP server that stands in for the weekstats feed, serving recorded snapshots in
+    order - one per request, repeating the last once they run out. Use the server's address as the
+    url for run(), and call shutdown() on it when finished.
+    :param snapshot_files: paths of recorded weekstats JSON files, in the order to serve them
+    :param host: interface to listen on
+    :param port: port to listen on, or 0 for any free port
+    :return: the running server
+    """
+    snapshots = [Path(snapshot_file).read_bytes() for snapshot_file in snapshot_files]
+    served = []
+
+    class ReplayHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = snapshots[min(len(served), len(snapshots) - 1)]
+            served.append(self.path)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), ReplayHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(week=None, interval=60, url=None, polls=None, on_update=print_scores, record_folder=None,
+        scoreboard=None):
+    """
+    Polls the weekstats feed and reports matchup scores whenever they change.
+    :param week: int for the fantasy week, defaults to the current week
+    :param interval: seconds between the start of each poll
+    :param url: weekstats URL, e.g. of a replay server, defaults to the NFL Fantasy API
+    :param polls: Optional number of polls to make, otherwise polls until interrupted
+    :param on_update: function called with the scoreboard each time a score changes
+    :param record_folder: Optional folder to save each snapshot in, for replaying later
+    :param scoreboard: Optional LiveScoreboard to update, otherwise one is built from the league
+    :return: the scoreboard
+    """
+    if scoreboard is None:
+        league = api.league()
+        scoreboard = build_scoreboard(league, week or league.current_week())
+
+    url = url or CONFIG.get('live_weekstats_url', WEEKSTATS_URL)
+    params = {'season': scoreboard.season, 'week': scoreboard.week}
+    if record_folder:
+        Path(record_folder).mkdir(parents=True, exist_ok=True)
+
+    poll = 0
+    while polls is None or poll < polls:
+        started = time.monotonic()
+        response = transport.get(url, params=params)
+        if response.status_code == 200:
+            if record_folder:
+                snapshot_file = Path(record_folder)/f'weekstats-{scoreboard.season}-{scoreboard.week}-{poll:04}.json'
+                snapshot_file.write_bytes(response.content)
+            if scoreboard.apply(response.json()):
+                on_update(scoreboard)
+        else:
+            log.warning(f'Weekstats poll returned {response.status_code}')
+
+        poll += 1
+        if polls is None or poll < polls:
+            time.sleep(max(0, interval - (time.monotonic() - started)))
+
+    return scoreboard
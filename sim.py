@@ -0,0 +1,245 @@
+"""
+Monte Carlo simulation of the rest of the fantasy season. Each starter's weekly score is drawn from
+their own history in player_weekly_points, the remaining schedule is played out many thousands of
+times, and the results give win and playoff probabilities for every team.
+"""
+
+# standard library imports
+from concurrent.futures import ProcessPoolExecutor
+import logging
+
+# third party imports
+import numpy as np
+import pandas as pd
+
+# local imports
+import api
+import db
+
+log = logging.getLogger()
+logging.basicConfig(filename='ffb.log', level=logging.DEBUG)
+
+CHUNK_SIZE = 10000
+
+
+def build_season(league=None, history_seasons=2):
+    """
+    Gathers everything a simulation needs from the league and the database: standings, remaining
+    schedule, starting lineups and the weekly points history of every starter.
+    :param league: Optional league object from the Yahoo API
+    :param history_seasons: number of seasons of weekly points to draw from, including the latest
+    :return: dict of NumPy arrays and lookups describing the season, for passing to simulate()
+    """
+    league = league or api.league()
+    settings = league.settings()
+    current_week = league.current_week()
+    last_week = int(settings.get('playoff_start_week', 14)) - 1
+
+    teams = league.teams()
+    team_names = [team['name'] for team in teams]
+    team_index = {name: i for i, name in enumerate(team_names)}
+
+    standings = {team['name']: team for team in league.standings()}
+    wins = np.array([float(standings[name]['outcome_totals']['wins'])
+                     + 0.5 * float(standings[name]['outcome_totals']['ties']) for name in team_names])
+    points_for = np.array([float(standings[name]['points_for']) for name in team_names])
+
+    schedule = [api.matchup_teams(league, week) for week in range(current_week, last_week + 1)]
+    home = np.array([[team_index[team1] for team1, _ in week] for week in schedule], dtype=int)
+    away = np.array([[team_index[team2] for _, team2 in week] for week in schedule], dtype=int)
+
+    crosswalk = db.crosswalk()
+    player_ids = []
+    player_teams = []
+    for team in teams:
+        roster = league.to_team(team['team_key']).roster(week=current_week)
+        for player in roster:
+            if player['selected_position'] in ['BN', 'IR']:
+                continue
+            player_ids.append(str(player['player_id']))
+            player_teams.append(team_index[team['name']])
+
+    team_matrix = np.zeros((len(player_ids), len(teams)), dtype=np.float32)
+    team_matrix[np.arange(len(player_ids)), player_teams] = 1
+
+    season = int(settings['season'])
+    samples, lengths = player_samples(player_ids, season - history_seasons + 1, crosswalk)
+
+    return {'team_names': team_names, 'player_ids': player_ids, 'team_matrix': team_matrix,
+            'samples': samples, 'lengths': lengths, 'home': home, 'away': away, 'wins': wins,
+            'points_for': points_for, 'playoff_teams': int(settings.get('num_playoff_teams', 4)),
+            'first_season': season - history_seasons + 1}
+
+
+def pickup_value(add_yahoo_id, drop_yahoo_id, team_name=None, season=None, n_sims=100000,
+                 processes=None, seed=None):
+    """
+    Estimates how much picking up a player changes a team's chances, by simulating the season with
+    and without the swap. Both runs use the same random numbers, so the difference isn't swamped by
+    simulation noise.
+    :param add_yahoo_id: Yahoo ID of the player to pick up
+    :param drop_yahoo_id: Yahoo ID of the team's starter they would replace
+    :param team_name: team making the pickup, defaults to the logged-in manager's team
+    :param season: Optional output of build_season(), to save rebuilding it
+    :param n_sims: number of seasons to simulate
+    :param processes: number of worker processes, defaults to the number of CPUs
+    :param seed: Optional random seed
+    :return: dict of the change in playoff probability and expected wins
+    """
+    league = None
+    if season is None:
+        league = api.league()
+        season = build_season(league)
+    if team_name is None:
+        league = league or api.league()
+        team_key = league.team_key()
+        team_name = next(team['name'] for team in league.teams() if team['team_key'] == team_key)
+
+    if team_name not in season['team_names']:
+        raise ValueError(f'No team named {team_name} in the league.')
+    team_index = season['team_names'].index(team_name)
+    starters = [row for row, yahoo_id in enumerate(season['player_ids'])
+                if yahoo_id == str(drop_yahoo_id) and season['team_matrix'][row, team_index] == 1]
+    if not starters:
+        raise ValueError(f'Player {drop_yahoo_id} is not a starter for {team_name}.')
+    drop_row = starters[0]
+    # requested alongside the league's starters, so a player with no history of their own (e.g. a
+    # rookie) draws from the starters at their position rather than scoring nothing
+    add_samples, add_lengths = player_samples(season['player_ids'] + [str(add_yahoo_id)], season['first_season'])
+    add_samples, add_lengths = add_samples[-1:], add_lengths[-1:]
+    width = max(season['samples'].shape[1], add_samples.shape[1])
+    swapped = dict(season)
+    swapped['samples'] = np.zeros((len(season['samples']), width), dtype=np.float32)
+    swapped['samples'][:, :season['samples'].shape[1]] = season['samples']
+    swapped['samples'][drop_row] = 0
+    swapped['samples'][drop_row, :add_samples.shape[1]] = add_samples[0]
+    swapped['lengths'] = season['lengths'].copy()
+    swapped['lengths'][drop_row] = add_lengths[0]
+
+    seed = seed if seed is not None else np.random.SeedSequence().entropy
+    before = simulate(season, n_sims, processes, seed).set_index('team')
+    after = simulate(swapped, n_sims, processes, seed).set_index('team')
+
+    return {'team': team_name,
+            'playoff_probability': after.loc[team_name, 'playoff_probability'],
+            'playoff_probability_change': (after.loc[team_name, 'playoff_probability']
+                                           - before.loc[team_name, 'playoff_probability']),
+            'expected_wins_change': after.loc[team_name, 'expected_wins'] - before.loc[team_name, 'expected_wins']}
+
+
+def player_samples(yahoo_ids, first_season, crosswalk=None):
+    """
+    Gets each player's weekly points history as rows of a padded array. Players with no history
+    draw from the pooled history of everyone else in the request at the same position.
+    :param yahoo_ids: list of Yahoo IDs
+    :param first_season: earliest season to include
+    :param crosswalk: Optional db.Crosswalk
+    :return: 2D float32 array of points (one row per player, zero padded) and array of row lengths
+    """
+    crosswalk = crosswalk or db.crosswalk()
+    players = [crosswalk.lookup('yahoo_id', yahoo_id) for yahoo_id in yahoo_ids]
+    nfl_ids = [player.nfl_id for player in players if player]
+
+    df = pd.DataFrame(columns=['player_nfl_id', 'points'])
+    if nfl_ids:
+        df = db.query_frame(f'''SELECT player_nfl_id, points FROM player_weekly_points
+                                WHERE season >= ? AND player_nfl_id IN ({",".join("?" * len(nfl_ids))})''',
+                            (first_season, *nfl_ids))
+    history = {nfl_id: group.to_numpy(dtype=np.float32) for nfl_id, group in df.groupby('player_nfl_id')['points']}
+
+    positions = {}
+    for player in players:
+        if player and player.nfl_id in history:
+            position = (player.eligible_positions or '').split(',')[0]
+            positions.setdefault(position, []).append(history[player.nfl_id])
+
+    rows = []
+    for yahoo_id, player in zip(yahoo_ids, players):
+        if player and player.nfl_id in history:
+            rows.append(history[player.nfl_id])
+            continue
+        position = (player.eligible_positions or '').split(',')[0] if player else ''
+        log.info(f'No points history for Yahoo ID {yahoo_id}, using pooled {position or "league"} history')
+        pooled = positions.get(position) or list(history.values()) or [np.zeros(1, dtype=np.float32)]
+        rows.append(np.concatenate(pooled))
+
+    lengths = np.array([len(row) for row in rows], dtype=np.int64)
+    samples = np.zeros((len(rows), max(lengths, default=1)), dtype=np.float32)
+    for i, row in enumerate(rows):
+        samples[i, :len(row)] = row
+
+    return samples, lengths
+
+
+def simulate(season, n_sims=100000, processes=None, seed=None):
+    """
+    Plays out the rest of the season many times, split into chunks across a pool of processes.
+    :param season: output of build_season()
+    :param n_sims: number of seasons to simulate
+    :param processes: number of worker processes, defaults to the number of CPUs
+    :param seed: Optional random seed, for repeatable results
+    :return: data frame of each team's playoff probability, expected final wins and probability of
+             winning their next matchup
+    """
+    chunks = [CHUNK_SIZE] * (n_sims // CHUNK_SIZE)
+    if n_sims % CHUNK_SIZE:
+        chunks.append(n_sims % CHUNK_SIZE)
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+
+    args = [season[key] for key in ['samples', 'lengths', 'team_matrix', 'home', 'away', 'wins',
+                                    'points_for', 'playoff_teams']]
+    n_teams = len(season['team_names'])
+    playoffs = np.zeros(n_teams)
+    total_wins = np.zeros(n_teams)
+    next_wins = np.zeros(n_teams)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(simulate_chunk, *args, chunk, chunk_seed)
+                   for chunk, chunk_seed in zip(chunks, seeds)]
+        for future in futures:
+            chunk_playoffs, chunk_wins, chunk_next_wins = future.result()
+            playoffs += chunk_playoffs
+            total_wins += chunk_wins
+            next_wins += chunk_next_wins
+
+    df = pd.DataFrame({'team': season['team_names'],
+                       'playoff_probability': playoffs / n_sims,
+                       'expected_wins': total_wins / n_sims,
+                       'next_win_probability': next_wins / n_sims if len(season['home']) else np.nan})
+    return df.sort_values('playoff_probability', ascending=False).reset_index(drop=True)
+
+
+def simulate_chunk(samples, lengths, team_matrix, home, away, wins, points_for, playoff_teams, n_sims,
+                   seed):
+    """
+    Simulates a batch of seasons at once, vectorised over simulations, players and matchups, looping
+    only over the remaining weeks.
+    :return: per-team arrays of playoff appearances, total final wins and wins in the next week
+    """
+    rng = np.random.default_rng(seed)
+    n_players, n_teams = team_matrix.shape
+    player_rows = np.arange(n_players)
+
+    sim_wins = np.tile(wins.astype(np.float64), (n_sims, 1))
+    sim_points = np.tile(points_for.astype(np.float64), (n_sims, 1))
+    next_wins = np.zeros(n_teams)
+
+    for week in range(len(home)):
+        draws = (rng.random((n_sims, n_players)) * lengths).astype(np.int64)
+        team_scores = samples[player_rows, draws] @ team_matrix
+        home_scores, away_scores = team_scores[:, home[week]], team_scores[:, away[week]]
+
+        home_result = (home_scores > away_scores) + 0.5 * (home_scores == away_scores)
+        week_wins = np.zeros((n_sims, n_teams))
+        week_wins[:, home[week]] = home_result
+        week_wins[:, away[week]] = 1 - home_result
+
+        sim_wins += week_wins
+        sim_points += team_scores
+        if week == 0:
+            next_wins = week_wins.sum(axis=0)
+
+    # rank on wins, then points for as the tiebreaker
+    ranking = np.argsort(-(sim_wins * 1e6 + sim_points), axis=1, kind='stable')
+    playoffs = np.bincount(ranking[:, :playoff_teams].ravel(), minlength=n_teams)
+
+    return playoffs, sim_wins.sum(axis=0), next_wins
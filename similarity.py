@@ -0,0 +1,184 @@
+"""
+Nearest-neighbour search over player-seasons, to find the historical players whose weekly scoring most
+resembles a given player's - e.g. to see how similar players went on to perform.
+"""
+
+# standard library imports
+import logging
+
+# third party imports
+import numpy as np
+import pandas as pd
+
+# local imports
+import db
+
+log = logging.getLogger()
+logging.basicConfig(filename='ffb.log', level=logging.DEBUG)
+
+# weekly points are sorted into a profile, with room for the 18-week regular seasons from 2021
+WEEKS = 18
+# points are divided by this so a typical week is comparable in size to a stat share
+POINTS_SCALE = 10.0
+SHARE_WEIGHT = 1.0
+
+_INDEX = None
+
+
+class ProfileIndex:
+    """
+    Feature matrix for every player-season, with one row per player-season: the player's weekly
+    points sorted best to worst, followed by the share of their points from each scoring stat.
+    """
+
+    def __init__(self, keys, positions, features, version):
+        """
+        :param keys: data frame of player_nfl_id and season for each row
+        :param positions: array of the position code for each row
+        :param features: 2D float32 array of features, one row per player-season
+        :param version: database ID and data version of the database the index was read from
+        """
+        self.keys = keys
+        self.positions = positions
+        self.features = features
+        self.norms = np.einsum('ij,ij->i', features, features)
+        self.version = version
+        self.rows = {(player_nfl_id, season): i
+                     for i, (player_nfl_id, season) in enumerate(zip(keys['player_nfl_id'], keys['season']))}
+
+    def query(self, player_nfl_id, season, k=10, same_position=True):
+        """
+        Finds the player-seasons closest to a given one.
+        :param player_nfl_id: NFL ID of the player to compare against
+        :param season: the season of theirs to compare
+        :param k: number of neighbours to return
+        :param same_position: only compare against players in the same position
+        :return: data frame of player_nfl_id, season, position and distance, closest first
+        """
+        row = self.rows.get((str(player_nfl_id), int(season)))
+        if row is None:
+            raise KeyError(f'No profile for player {player_nfl_id} in {season}')
+
+        candidates = np.flatnonzero(self.keys['player_nfl_id'].to_numpy() != str(player_nfl_id))
+        if same_position:
+            candidates = candidates[self.positions[candidates] == self.positions[row]]
+
+        target = self.features[row]
+        sq_distances = self.norms[candidates] - 2 * self.features[candidates] @ target + self.norms[row]
+        k = min(k, len(candidates))
+        nearest = np.argpartition(sq_distances, k - 1)[:k] if k else np.array([], dtype=int)
+        nearest = nearest[np.argsort(sq_distances[nearest])]
+
+        df = self.keys.iloc[candidates[nearest]].reset_index(drop=True)
+        df['position'] = self.positions[candidates[nearest]]
+        df['distance'] = np.sqrt(np.maximum(sq_distances[nearest], 0))
+        return df
+
+
+def load_index():
+    """
+    Gets the profile index, reading it from the database on first use and again whenever the data
+    version shows it has been rebuilt, or a different database is in use.
+    :return: ProfileIndex
+    """
+    global _INDEX
+    conn, _ = db.connect()
+    version = (db.database_id(conn), db.data_version(conn))
+    if _INDEX is None or _INDEX.version != version:
+        df = db.query_frame('''SELECT player_nfl_id, season, position, points, shares
+                               FROM player_profile
+                               ORDER BY season, player_nfl_id''')
+        if df.empty:
+            features = np.zeros((0, WEEKS), dtype=np.float32)
+        else:
+            points = np.vstack([np.frombuffer(blob, dtype=np.float32) for blob in df['points']])
+            shares = np.vstack([np.frombuffer(blob, dtype=np.float32) for blob in df['shares']])
+            features = np.hstack([points / POINTS_SCALE, shares * SHARE_WEIGHT]).astype(np.float32)
+        _INDEX = ProfileIndex(df[['player_nfl_id', 'season']], df['position'].to_numpy(dtype=object),
+                              features, version)
+    return _INDEX
+
+
+def similar_players(player_nfl_id, season, k=10, same_position=True):
+    """
+    Finds the player-seasons most like a given player's season, with player names.
+    :param player_nfl_id: NFL ID of the player
+    :param season: integer season e.g. 2019
+    :param k: number of similar player-seasons to return
+    :param same_position: only compare against players in the same position
+    :return: data frame of similar player-seasons, most similar first
+    """
+    df = load_index().query(player_nfl_id, season, k, same_position)
+    crosswalk = db.crosswalk()
+    df['nfl_name'] = [getattr(crosswalk.lookup('nfl_id', nfl_id), 'nfl_name', None)
+                      for nfl_id in df['player_nfl_id']]
+    return df
+
+
+def update_index(seasons=None):
+    """
+    Rebuilds the profiles for the given seasons, leaving other seasons' profiles as they were. Run
+    after loading new weeks, with the seasons they belong to.
+    :param seasons: iterable of seasons to rebuild, defaults to every season
+    :return: nothing
+    """
+    conn, curs = db.connect()
+    curs.execute('''CREATE TABLE IF NOT EXISTS player_profile (
+                    player_nfl_id TEXT,
+                    season INTEGER,
+                    position TEXT,
+                    points BLOB,
+                    shares BLOB,
+                    PRIMARY KEY (player_nfl_id, season))''')
+    conn.commit()
+
+    stat_ids = [row['nfl_id'] for row in curs.execute('''SELECT nfl_id FROM statline
+                                                         WHERE points IS NOT NULL AND points != 0
+                                                         ORDER BY nfl_id''').fetchall()]
+    row = curs.execute('SELECT shares FROM player_profile LIMIT 1').fetchone()
+    if seasons is None or (row and len(row['shares']) != 4 * len(stat_ids)):
+        # scoring stats have changed since the index was built, so every season needs rebuilding
+        seasons = [row['season'] for row in
+                   curs.execute('SELECT DISTINCT season FROM player_weekly_points').fetchall()]
+
+    crosswalk = db.crosswalk()
+    stat_index = pd.Series(range(len(stat_ids)), index=stat_ids)
+    for season in sorted(set(seasons)):
+        weekly = db.query_frame('''SELECT player_nfl_id, week, points FROM player_weekly_points
+                                   WHERE season = ? AND week <= ?''', (season, WEEKS))
+        by_stat = db.query_frame('''SELECT w.player_nfl_id, w.stat_nfl_id,
+                                    sum(w.stat_vol * s.points) as points
+                                    FROM weekstat w INNER JOIN statline s ON w.stat_nfl_id = s.nfl_id
+                                    WHERE w.season = ? AND s.points IS NOT NULL AND s.points != 0
+                                    GROUP BY w.player_nfl_id, w.stat_nfl_id''', (season,))
+
+        players = pd.Index(sorted(set(weekly['player_nfl_id'])))
+        points = np.zeros((len(players), WEEKS), dtype=np.float32)
+        points[players.get_indexer(weekly['player_nfl_id']), weekly['week'].to_numpy(dtype=int) - 1] = \
+            weekly['points'].to_numpy(dtype=np.float32)
+        points = -np.sort(-points, axis=1)
+
+        shares = np.zeros((len(players), len(stat_ids)), dtype=np.float32)
+        if not by_stat.empty:
+            rows = players.get_indexer(by_stat['player_nfl_id'])
+            cols = stat_index.reindex(by_stat['stat_nfl_id']).to_numpy()
+            known = (rows >= 0) & ~np.isnan(cols)
+            np.add.at(shares, (rows[known], cols[known].astype(int)),
+                      by_stat['points'].to_numpy(dtype=np.float32)[known])
+            totals = np.abs(shares).sum(axis=1, keepdims=True)
+            shares = np.divide(shares, totals, out=np.zeros_like(shares), where=totals > 0)
+
+        positions = [getattr(crosswalk.lookup('nfl_id', nfl_id), 'eligible_positions', None)
+                     for nfl_id in players]
+        params = [(nfl_id, season, position.split(',')[0] if position else None,
+                   points[i].tobytes(), shares[i].tobytes())
+                  for i, (nfl_id, position) in enumerate(zip(players, positions))]
+
+        with conn:
+            curs.execute('DELETE FROM player_profile WHERE season = ?', (season,))
+            curs.executemany('''INSERT INTO player_profile
+                                (player_nfl_id, season, position, points, shares)
+                                VALUES
+                                (?, ?, ?, ?, ?)''', params)
+            db.bump_data_version(conn)
+        log.info(f'Rebuilt {len(params)} player profiles for {season}')
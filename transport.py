@@ -0,0 +1,204 @@
+"""
+Shared HTTP transport for every network call made by the fantasy football modules: pooled keep-alive
+connections, per-host rate limiting, timeouts, retries with jittered backoff and latency counters.
+"""
+
+# Standard library imports
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Third-party imports
+import requests
+from requests.adapters import HTTPAdapter
+import yaml
+
+with open('_config.yml', 'r') as config_file:
+    CONFIG = yaml.safe_load(config_file)
+
+log = logging.getLogger()
+logging.basicConfig(filename='ffb.log', level=logging.DEBUG)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_TRANSPORT = None
+_TRANSPORT_LOCK = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Allows requests at an average rate, with short bursts up to the bucket capacity.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token from the bucket, waiting until one is available.
+        :return: seconds spent waiting
+        """
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class Transport:
+    """
+    A pooled HTTP session that rate limits, times out and retries every request, and keeps latency
+    counters for each host.
+    """
+
+    def __init__(self, rate=2.0, burst=5, timeout=(5, 30), retries=3, backoff=0.5, host_rates=None,
+                 pool_size=10):
+        """
+        :param rate: default requests per second allowed to each host
+        :param burst: number of requests that can be made to a host at once before rate limiting
+        :param timeout: connect and read timeouts in seconds
+        :param retries: number of times to retry a request after a connection error or retryable status
+        :param backoff: base delay in seconds between retries, doubled on each attempt
+        :param host_rates: Optional dict of requests per second for particular hosts
+        :param pool_size: number of keep-alive connections held open per host
+        """
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.host_rates = host_rates or {}
+
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+        self.buckets = {}
+        self.latency = {}
+        self.lock = threading.Lock()
+
+    def adopt(self, session):
+        """
+        Routes requests made through another session, e.g. an OAuth session owned by a client
+        library, through this transport's connection pool, rate limits, retries and counters.
+        :param session: requests.Session (or subclass) to adopt
+        :return: the same session
+        """
+        send = session.request
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        session.request = lambda method, url, **kwargs: self.request(method, url, send=send, **kwargs)
+        return session
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def request(self, method, url, send=None, **kwargs):
+        """
+        Makes a request, waiting for the host's rate limit and retrying failures with jittered
+        exponential backoff.
+        :param method: HTTP method e.g. 'GET'
+        :param url: full URL to request
+        :param send: Optional function to make the request with, defaults to the shared session
+        :param kwargs: passed through to requests
+        :return: requests.Response
+        """
+        send = send or self.session.request
+        host = urlsplit(url).netloc
+        bucket = self._bucket(host)
+        kwargs.setdefault('timeout', self.timeout)
+
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            start = time.perf_counter()
+            try:
+                response = send(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(host, time.perf_counter() - start, error=True)
+                if attempt == self.retries:
+                    raise
+                log.warning(f'{method} {url} failed ({e!r}), retry {attempt + 1} of {self.retries}')
+                time.sleep(self._delay(attempt))
+                continue
+
+            self._record(host, time.perf_counter() - start, error=response.status_code >= 400)
+            if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                return response
+
+            log.warning(f'{method} {url} returned {response.status_code}, '
+                        f'retry {attempt + 1} of {self.retries}')
+            retry_after = response.headers.get('Retry-After', '')
+            time.sleep(float(retry_after) if retry_after.isdigit() else self._delay(attempt))
+
+    def stats(self):
+        """
+        Gets the latency counters for each host requested so far.
+        :return: dict keyed by host, of dicts with request count, error count, mean and max seconds
+        """
+        with self.lock:
+            return {host: {'requests': counter['requests'],
+                           'errors': counter['errors'],
+                           'mean_seconds': counter['seconds'] / counter['requests'],
+                           'max_seconds': counter['max_seconds']}
+                    for host, counter in self.latency.items()}
+
+    def _bucket(self, host):
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.host_rates.get(host, self.rate), self.burst)
+            return self.buckets[host]
+
+    def _delay(self, attempt):
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def _record(self, host, seconds, error=False):
+        with self.lock:
+            counter = self.latency.setdefault(host, {'requests': 0, 'errors': 0, 'seconds': 0.0,
+                                                     'max_seconds': 0.0})
+            counter['requests'] += 1
+            counter['errors'] += int(error)
+            counter['seconds'] += seconds
+            counter['max_seconds'] = max(counter['max_seconds'], seconds)
+
+
+def get(url, **kwargs):
+    """
+    Makes a GET request through the shared transport.
+    :param url: full URL to request
+    :param kwargs: passed through to requests
+    :return: requests.Response
+    """
+    return transport().get(url, **kwargs)
+
+
+def transport():
+    """
+    Gets the transport shared by the whole process, creating it from the config file on first use.
+    :return: Transport
+    """
+    global _TRANSPORT
+    with _TRANSPORT_LOCK:
+        if _TRANSPORT is None:
+            settings = CONFIG.get('http', {})
+            _TRANSPORT = Transport(rate=settings.get('rate', 2.0),
+                                   burst=settings.get('burst', 5),
+                                   timeout=tuple(settings.get('timeout', (5, 30))),
+                                   retries=settings.get('retries', 3),
+                                   backoff=settings.get('backoff', 0.5),
+                                   host_rates=settings.get('host_rates'))
+        return _TRANSPORT
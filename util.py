@@ -9,6 +9,7 @@ import requests
 
 # local imports
 import api
+import transport
 
 
 def download_stat_file(stat_type, week):
@@ -26,7 +27,7 @@ def download_stat_file(stat_type, week):
     else:
         raise RuntimeError("stat_type must be 'week' or 'season'")
 
-    resp = requests.get(url)
+    resp = transport.get(url)
 
     if resp.status_code == 200:
         filename = f'data_in/nfl-{stat_type}stats-2019-{week:02}.json'